@@ -0,0 +1,114 @@
+import time
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+
+from bson import ObjectId, json_util
+
+from app.database import redis, mongo
+
+LOCAL_MAXSIZE = 10000
+LOCAL_TTL = 5
+REDIS_TTL = 60 * 5
+
+totals = Counter()
+_request_stats = ContextVar('cache_stats', default=None)
+
+
+class LRUCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (value, time.monotonic() + (ttl if ttl is not None else self.ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+
+local = LRUCache(LOCAL_MAXSIZE, LOCAL_TTL)
+
+
+def start_request():
+    stats = Counter()
+    _request_stats.set(stats)
+    return stats
+
+
+def format_stats(stats):
+    return ';'.join(f'{name}={stats[name]}' for name in ('local', 'redis', 'miss'))
+
+
+def _record(name):
+    totals[name] += 1
+    stats = _request_stats.get()
+    if stats is not None:
+        stats[name] += 1
+
+
+def cache_key(collection, _id):
+    return f'cache:{collection}:{_id}'
+
+
+async def get_document(collection, _id):
+    key = cache_key(collection, _id)
+
+    value = local.get(key)
+    if value is not None:
+        _record('local')
+        return json_util.loads(value)
+
+    value = await redis.get(key)
+    if value is not None:
+        _record('redis')
+        local.set(key, value)
+        return json_util.loads(value)
+
+    _record('miss')
+    doc = await mongo[collection].find_one({'_id': ObjectId(_id)})
+    if doc is not None:
+        value = json_util.dumps(doc)
+        await redis.set(key, value, ex=REDIS_TTL)
+        local.set(key, value)
+    return doc
+
+
+async def invalidate(collection, _id):
+    key = cache_key(collection, _id)
+    local.delete(key)
+    await redis.delete(key)
+
+
+async def get_post(post_id):
+    return await get_document('posts', post_id)
+
+
+async def get_user(user_id):
+    user = await get_document('users', user_id)
+    # 탈퇴 처리 중인 유저는 없는 유저로 취급한다
+    if user is not None and user.get('deleted_at'):
+        return None
+    return user
+
+
+async def invalidate_post(post_id):
+    await invalidate('posts', post_id)
+
+
+async def invalidate_user(user_id):
+    await invalidate('users', user_id)
@@ -1,5 +1,8 @@
+import os
+
 import stripe
 from dotenv import dotenv_values
 
-config = dotenv_values()
+# .env 가 없는 환경(컨테이너, 벤치마크)에서는 환경 변수를 사용한다
+config = {**os.environ, **dotenv_values()}
 stripe.api_key = config['STRIPE_SECRET_KEY']
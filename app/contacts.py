@@ -0,0 +1,44 @@
+import asyncio
+from hashlib import sha256
+
+from pymongo import UpdateOne
+
+from app.database import mongo
+from app.feed import AUTHOR_PROJECTION
+
+CONTACTS_CHUNK = 1000
+BACKFILL_BATCH = 1000
+
+
+def phone_hash(phone):
+    return sha256(phone.encode()).hexdigest()
+
+
+async def _resolve_chunk(hashes, exclude_user_id):
+    users = mongo.users.find({
+        'phone_hash': {'$in': hashes},
+        '_id': {'$ne': exclude_user_id},
+        'deleted_at': {'$exists': False},
+    }, {**AUTHOR_PROJECTION, 'phone_hash': 1})
+    return await users.to_list(None)
+
+
+async def resolve(hashes, exclude_user_id=None):
+    hashes = list(dict.fromkeys(hashes))
+    chunks = await asyncio.gather(*[
+        _resolve_chunk(hashes[i:i + CONTACTS_CHUNK], exclude_user_id) for i in range(0, len(hashes), CONTACTS_CHUNK)
+    ])
+    return [user for chunk in chunks for user in chunk]
+
+
+async def backfill():
+    # phone_hash 가 없는 기존 유저에 채워 넣는다
+    while users := await mongo.users.find({'phone_hash': {'$exists': False}, 'deleted_at': {'$exists': False}},
+                                          {'phone': 1}).to_list(BACKFILL_BATCH):
+        await mongo.users.bulk_write([
+            UpdateOne({'_id': user['_id']}, {'$set': {'phone_hash': phone_hash(user['phone'])}}) for user in users
+        ], ordered=False)
+
+
+if __name__ == '__main__':
+    asyncio.run(backfill())
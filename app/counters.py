@@ -0,0 +1,132 @@
+import asyncio
+import logging
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from redis.commands.core import AsyncScript
+
+from app.database import redis, mongo
+
+logger = logging.getLogger(__name__)
+
+COUNTER_FIELDS = ('like_count', 'comment_count')
+COUNTER_TTL = 60 * 60 * 24
+DIRTY_KEY = 'post_counters:dirty'
+FLUSH_INTERVAL = 5
+FLUSH_BATCH = 500
+ONCE_TTL = 60 * 60 * 24
+
+# token 이 처음일 때만 반영한다. 중단 후 다시 실행하는 작업이 같은 증감을 두 번 하지 않게 한다
+# ARGV: ttl, field, 게시물마다 (post_id, amount, like_count seed, comment_count seed)
+INCR_ONCE = AsyncScript(redis, b"""
+if not redis.call('SET', KEYS[1], 1, 'NX', 'EX', ARGV[1]) then
+    return 0
+end
+for i = 3, #KEYS do
+    local base = (i - 3) * 4 + 2
+    if ARGV[base + 3] ~= '' then
+        redis.call('HSETNX', KEYS[i], 'like_count', ARGV[base + 3])
+        redis.call('HSETNX', KEYS[i], 'comment_count', ARGV[base + 4])
+    end
+    redis.call('HINCRBY', KEYS[i], ARGV[2], ARGV[base + 2])
+    redis.call('PERSIST', KEYS[i])
+    redis.call('SADD', KEYS[2], ARGV[base + 1])
+end
+return 1
+""")
+
+
+def counter_key(post_id):
+    return f'post_counters:{post_id}'
+
+
+async def _seed(post):
+    # 카운터가 없던 기존 게시물은 컬렉션에서 직접 센다
+    like_count = post.get('like_count')
+    if like_count is None:
+        like_count = await mongo.likes.count_documents({'post_id': post['_id']})
+    comment_count = post.get('comment_count')
+    if comment_count is None:
+        comment_count = await mongo.comments.count_documents({'post_id': post['_id']})
+    return {'like_count': like_count, 'comment_count': comment_count}
+
+
+async def incr(post, field, amount=1):
+    key = counter_key(post['_id'])
+    if not await redis.exists(key):
+        seed = await _seed(post)
+    else:
+        seed = {}
+
+    pipe = redis.pipeline()
+    for name, value in seed.items():
+        pipe.hsetnx(key, name, value)
+    pipe.hincrby(key, field, amount)
+    pipe.persist(key)
+    pipe.sadd(DIRTY_KEY, str(post['_id']))
+    await pipe.execute()
+
+
+async def incr_once(token, post_amounts, field):
+    keys, args = [token, DIRTY_KEY], [ONCE_TTL, field]
+    for post, amount in post_amounts:
+        key = counter_key(post['_id'])
+        seed = {} if await redis.exists(key) else await _seed(post)
+        keys.append(key)
+        args += [str(post['_id']), amount, seed.get('like_count', ''), seed.get('comment_count', '')]
+    return await INCR_ONCE(keys=keys, args=args)
+
+
+async def discard(post_id):
+    pipe = redis.pipeline()
+    pipe.delete(counter_key(post_id))
+    pipe.srem(DIRTY_KEY, str(post_id))
+    await pipe.execute()
+
+
+async def attach(posts):
+    if not posts:
+        return posts
+    pipe = redis.pipeline(transaction=False)
+    for post in posts:
+        pipe.hmget(counter_key(post['_id']), *COUNTER_FIELDS)
+    for post, values in zip(posts, await pipe.execute()):
+        for name, value in zip(COUNTER_FIELDS, values):
+            post[name] = int(value) if value is not None else post.get(name, 0)
+    return posts
+
+
+async def flush():
+    flushed = 0
+    while post_ids := await redis.spop(DIRTY_KEY, FLUSH_BATCH):
+        pipe = redis.pipeline(transaction=False)
+        for post_id in post_ids:
+            pipe.hmget(counter_key(post_id), *COUNTER_FIELDS)
+        requests = []
+        for post_id, values in zip(post_ids, await pipe.execute()):
+            counts = {name: int(value) for name, value in zip(COUNTER_FIELDS, values) if value is not None}
+            if counts:
+                requests.append(UpdateOne({'_id': ObjectId(post_id)}, {'$set': counts}))
+        if requests:
+            try:
+                await mongo.posts.bulk_write(requests, ordered=False)
+            except Exception:
+                await redis.sadd(DIRTY_KEY, *post_ids)
+                raise
+
+        # 반영된 카운터는 일정 시간 뒤 만료시켜 Redis 에 쌓이지 않게 한다
+        pipe = redis.pipeline(transaction=False)
+        for post_id in post_ids:
+            pipe.expire(counter_key(post_id), COUNTER_TTL)
+        await pipe.execute()
+        flushed += len(post_ids)
+    return flushed
+
+
+async def run_flusher():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await flush()
+        except Exception:
+            logger.exception('카운터 flush 실패')
@@ -1,21 +1,57 @@
-from pymongo import MongoClient
-from redis import Redis
+import asyncio
+
+from motor.motor_asyncio import AsyncIOMotorClient
 
 from app.config import config
+from app.lazy import LazyClient
+from app.metrics import InstrumentedRedis, MongoListener
+
+WARMUP_CONNECTIONS = int(config.get('WARMUP_CONNECTIONS') or 10)
+
+
+def _create_redis():
+    return InstrumentedRedis(
+        host=config['INFRASTRUCTURE'],
+        port=6379,
+        password=config['REDIS_PASSWORD'],
+        decode_responses=True,
+        max_connections=int(config.get('REDIS_MAX_CONNECTIONS') or 512),
+    )
+
+
+def _create_client():
+    return AsyncIOMotorClient(
+        host=config['INFRASTRUCTURE'],
+        port=27017,
+        username=config['MONGO_USERNAME'],
+        password=config['MONGO_PASSWORD'],
+        maxPoolSize=int(config.get('MONGO_MAX_POOL_SIZE') or 200),
+        minPoolSize=int(config.get('MONGO_MIN_POOL_SIZE') or 0),
+        event_listeners=[MongoListener()],
+    )
+
+
+# 워커 프로세스에서 처음 사용할 때 연결한다
+redis = LazyClient(_create_redis)
+client = LazyClient(_create_client)
+mongo = LazyClient(lambda: client.get().mycut4cut)
+
+
+async def connect():
+    await client.admin.command('ping')
+    await redis.ping()
 
-redis = Redis(
-    host=config['INFRASTRUCTURE'],
-    port=6379,
-    password=config['REDIS_PASSWORD'],
-    decode_responses=True,
-)
 
-client = MongoClient(
-    host=config['INFRASTRUCTURE'],
-    port=27017,
-    username=config['MONGO_USERNAME'],
-    password=config['MONGO_PASSWORD'],
-)
+async def warmup():
+    # 요청을 받기 전에 커넥션 풀을 채워 첫 요청들이 연결 수립을 기다리지 않게 한다
+    await asyncio.gather(*[client.admin.command('ping') for _ in range(WARMUP_CONNECTIONS)])
+    await asyncio.gather(*[redis.ping() for _ in range(WARMUP_CONNECTIONS)])
 
-mongo = client.mycut4cut
 
+async def close():
+    if client.loaded:
+        client.close()
+    if redis.loaded:
+        await redis.aclose()
+    for lazy in (mongo, client, redis):
+        lazy.reset()
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pymongo import DeleteOne, ReturnDocument
+
+from app import cache, counters, graph, like_buffer, trending
+from app.database import redis, mongo
+from app.timeline import HEAVY_POSTERS_KEY, remove_post, timeline_key
+
+logger = logging.getLogger(__name__)
+
+DELETE_BATCH = 500
+JOB_LEASE = 60 * 5
+POLL_INTERVAL = 5
+STAGES = ('posts', 'likes', 'comments', 'follows', 'inbox', 'user')
+
+
+async def tombstone(user_id):
+    # 전화번호는 바로 비워 두어 같은 번호로 다시 가입할 수 있게 한다
+    user = await mongo.users.find_one_and_update(
+        {'_id': ObjectId(user_id), 'deleted_at': {'$exists': False}},
+        {'$set': {'deleted_at': datetime.now(), 'phone': f'deleted:{user_id}'}, '$unset': {'phone_hash': ''}},
+        projection={'phone': 1},
+    )
+    if user is None:
+        return False
+    await mongo.deletion_jobs.insert_one({
+        '_id': ObjectId(user_id),
+        'phone': user['phone'],
+        # 이 시점까지 만들어진 인박스만 지운다. ObjectId 는 초 단위이므로 현재 초까지 포함한다
+        'inbox_until': ObjectId.from_datetime(datetime.now(timezone.utc) + timedelta(seconds=1)),
+        'stage': STAGES[0],
+        'deleted': {},
+        'created_at': datetime.now(),
+        'locked_until': datetime.now(),
+    })
+    await cache.invalidate_user(user_id)
+    return True
+
+
+async def _delete_batches(job, stage, collection, query, projection=None):
+    # 딸린 데이터를 먼저 정리한 뒤에 지운다. 중단되어도 다시 실행하면 같은 배치를 다시 찾는다
+    while docs := await mongo[collection].find(query, projection).sort('_id', 1).limit(DELETE_BATCH).to_list(None):
+        yield docs
+        await mongo[collection].bulk_write([DeleteOne({'_id': doc['_id']}) for doc in docs], ordered=False)
+        await _checkpoint(job, stage, collection, len(docs))
+
+
+async def _checkpoint(job, stage, collection=None, count=0):
+    update = {'$set': {'stage': stage, 'locked_until': datetime.now() + timedelta(seconds=JOB_LEASE)}}
+    if count:
+        update['$inc'] = {f'deleted.{collection}': count}
+    await mongo.deletion_jobs.update_one({'_id': job['_id']}, update)
+
+
+async def _decrement(job, docs, field):
+    # 배치의 첫 _id 를 token 으로 써서 지우기 전에 중단된 배치를 다시 빼지 않는다
+    post_counts = Counter(doc['post_id'] for doc in docs)
+    posts = await mongo.posts.find({'_id': {'$in': list(post_counts)}}).to_list(None)
+    if posts:
+        token = f'deletion:{job["_id"]}:{field}:{docs[0]["_id"]}'
+        await counters.incr_once(token, [(post, -post_counts[post['_id']]) for post in posts], field)
+
+
+async def _delete_posts(job):
+    async for posts in _delete_batches(job, 'posts', 'posts', {'user_id': job['_id']}):
+        post_ids = [post['_id'] for post in posts]
+        # 다른 유저가 남긴 좋아요와 댓글도 함께 지운다
+        for collection in ('likes', 'comments'):
+            async for _ in _delete_batches(job, 'posts', collection, {'post_id': {'$in': post_ids}}, {'_id': 1}):
+                pass
+        for post in posts:
+            await remove_post(post)
+            await counters.discard(post['_id'])
+            await trending.remove_post(post['_id'])
+            await cache.invalidate_post(post['_id'])
+
+
+async def _delete_likes(job):
+    # 버퍼에 남은 좋아요가 Mongo 에 반영된 뒤에 지워야 카운터가 맞는다
+    while await like_buffer.has_pending(str(job['_id'])):
+        await like_buffer.flush()
+        await asyncio.sleep(like_buffer.FLUSH_INTERVAL)
+    async for likes in _delete_batches(job, 'likes', 'likes', {'user_id': str(job['_id'])}, {'post_id': 1}):
+        await _decrement(job, likes, 'like_count')
+
+
+async def _delete_comments(job):
+    async for comments in _delete_batches(job, 'comments', 'comments', {'user_id': str(job['_id'])}, {'post_id': 1}):
+        await _decrement(job, comments, 'comment_count')
+
+
+async def _delete_follows(job):
+    user_id = str(job['_id'])
+    query = {'$or': [{'from_user_id': job['_id']}, {'to_user_id': job['_id']}]}
+    async for follows in _delete_batches(job, 'follows', 'follows', query, {'from_user_id': 1, 'to_user_id': 1}):
+        pipe = redis.pipeline(transaction=False)
+        for follow in follows:
+            from_user_id, to_user_id = str(follow['from_user_id']), str(follow['to_user_id'])
+            if to_user_id == user_id:
+                pipe.srem(graph.following_key(from_user_id), user_id)
+            else:
+                pipe.srem(graph.followers_key(to_user_id), user_id)
+                pipe.srem(graph.pending_key(to_user_id), user_id)
+        await pipe.execute()
+
+
+async def _delete_inbox(job):
+    # 탈퇴 후 같은 번호로 다시 가입한 유저의 인박스는 남긴다
+    query = {'phone': job['phone']}
+    if 'inbox_until' in job:
+        query['_id'] = {'$lt': job['inbox_until']}
+    async for _ in _delete_batches(job, 'inbox', 'inbox', query, {'_id': 1}):
+        pass
+
+
+async def _delete_user(job):
+    user_id = str(job['_id'])
+    pipe = redis.pipeline(transaction=False)
+    pipe.delete(timeline_key(user_id), graph.following_key(user_id), graph.followers_key(user_id),
+                graph.pending_key(user_id), graph.loaded_key(user_id))
+    pipe.srem(HEAVY_POSTERS_KEY, user_id)
+    await pipe.execute()
+    await mongo.users.delete_one({'_id': job['_id']})
+    await cache.invalidate_user(user_id)
+
+
+STAGE_HANDLERS = {
+    'posts': _delete_posts,
+    'likes': _delete_likes,
+    'comments': _delete_comments,
+    'follows': _delete_follows,
+    'inbox': _delete_inbox,
+    'user': _delete_user,
+}
+
+
+async def claim_job():
+    now = datetime.now()
+    return await mongo.deletion_jobs.find_one_and_update(
+        {'locked_until': {'$lt': now}},
+        {'$set': {'locked_until': now + timedelta(seconds=JOB_LEASE)}},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def run_job(job):
+    # 중단된 작업은 마지막 체크포인트의 단계부터 이어서 진행한다
+    for stage in STAGES[STAGES.index(job['stage']):]:
+        await _checkpoint(job, stage)
+        await STAGE_HANDLERS[stage](job)
+    await mongo.deletion_jobs.delete_one({'_id': job['_id']})
+
+
+async def run_worker():
+    while True:
+        try:
+            while job := await claim_job():
+                await run_job(job)
+        except Exception:
+            logger.exception('계정 삭제 작업 실패')
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    asyncio.run(run_worker())
@@ -1,18 +1,50 @@
+import logging
+import time
+from hashlib import sha256
+
 from fastapi import HTTPException, Depends
 from fastapi.security import HTTPBearer
 from jose import jwt
 
+from app.cache import LRUCache
 from app.config import config
+from app.database import redis
+
+logger = logging.getLogger(__name__)
 
 security = HTTPBearer()
 JWT_SECRET = config['JWT_SECRET']
 
+VERIFIED_TOKENS_MAXSIZE = 10000
+VERIFIED_TOKENS_TTL = 60 * 10
+verified_tokens = LRUCache(VERIFIED_TOKENS_MAXSIZE, VERIFIED_TOKENS_TTL)
+
+
+def token_version_key(user_id):
+    return f'token_version:{user_id}'
+
+
+async def get_token_version(user_id):
+    return int(await redis.get(token_version_key(user_id)) or 0)
+
+
+async def revoke_tokens(user_id):
+    await redis.incr(token_version_key(user_id))
+
+
+async def get_current_user(token=Depends(security)):
+    key = sha256(token.credentials.encode()).hexdigest()
+    payload = verified_tokens.get(key)
+    if payload is None:
+        try:
+            payload = jwt.decode(token.credentials, JWT_SECRET, algorithms=['HS256'])
+        except Exception:
+            logger.debug('토큰 검증 실패', exc_info=True)
+            raise HTTPException(status_code=401, detail='Invalid token')
+        # 만료 시각이 지난 토큰이 캐시에 남지 않도록 TTL 을 exp 이내로 제한한다
+        verified_tokens.set(key, payload, ttl=min(VERIFIED_TOKENS_TTL, payload['exp'] - time.time()))
 
-def get_current_user(token=Depends(security)):
-    try:
-        payload = jwt.decode(token.credentials, JWT_SECRET, algorithms=['HS256'])
-    except Exception as e:
-        print(e)
+    if payload.get('ver', 0) != await get_token_version(payload['_id']):
         raise HTTPException(status_code=401, detail='Invalid token')
 
-    return payload
+    return dict(payload)
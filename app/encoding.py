@@ -0,0 +1,43 @@
+import functools
+from typing import Any
+
+import orjson
+from bson import ObjectId
+from fastapi.responses import JSONResponse, Response
+from fastapi.routing import APIRoute
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(doc) -> bytes:
+    return orjson.dumps(doc, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class BSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def _bson_endpoint(endpoint):
+    @functools.wraps(endpoint)
+    async def wrapped(*args, **kw):
+        res = await endpoint(*args, **kw)
+        if isinstance(res, Response):
+            return res
+        return BSONResponse(res)
+
+    wrapped.bson_response = True
+    return wrapped
+
+
+class BSONRoute(APIRoute):
+    # 엔드포인트가 반환한 dict 를 그대로 BSONResponse 로 감싸 jsonable_encoder 를 거치지 않게 한다
+    def __init__(self, path, endpoint, **kwargs):
+        # include_router 는 이미 감싼 endpoint 로 라우트를 다시 만들므로 한 번만 감싼다
+        if not getattr(endpoint, 'bson_response', False):
+            endpoint = _bson_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
@@ -0,0 +1,20 @@
+from app.database import mongo
+
+AUTHOR_PROJECTION = {'name': 1, 'handle': 1, 'picture': 1}
+
+AUTHOR_LOOKUP = [
+    {'$lookup': {
+        'from': 'users',
+        'localField': 'user_id',
+        'foreignField': '_id',
+        'pipeline': [{'$project': AUTHOR_PROJECTION}],
+        'as': 'author',
+    }},
+    {'$unwind': {'path': '$author', 'preserveNullAndEmptyArrays': True}},
+]
+
+
+async def get_cards(post_ids):
+    # 작성자 정보를 함께 붙여 클라이언트가 유저를 따로 조회하지 않게 한다
+    pipeline = [{'$match': {'_id': {'$in': post_ids}}}, *AUTHOR_LOOKUP]
+    return {post['_id']: post async for post in mongo.posts.aggregate(pipeline)}
@@ -0,0 +1,146 @@
+import asyncio
+
+from bson import ObjectId
+
+from app.database import redis, mongo
+
+ACCEPTED = 'accepted'
+PENDING = 'pending'
+
+
+def following_key(user_id):
+    return f'following:{user_id}'
+
+
+def followers_key(user_id):
+    return f'followers:{user_id}'
+
+
+def pending_key(user_id):
+    return f'pending:{user_id}'
+
+
+def loaded_key(user_id):
+    return f'graph:loaded:{user_id}'
+
+
+async def rebuild(user_id):
+    following, followers, pending = [], [], []
+    async for follow in mongo.follows.find({'from_user_id': ObjectId(user_id), 'status': ACCEPTED},
+                                           {'to_user_id': 1}):
+        following.append(str(follow['to_user_id']))
+    async for follow in mongo.follows.find({'to_user_id': ObjectId(user_id)}, {'from_user_id': 1, 'status': 1}):
+        (followers if follow.get('status') == ACCEPTED else pending).append(str(follow['from_user_id']))
+
+    pipe = redis.pipeline()
+    pipe.delete(following_key(user_id), followers_key(user_id), pending_key(user_id))
+    for key, members in ((following_key(user_id), following), (followers_key(user_id), followers),
+                         (pending_key(user_id), pending)):
+        if members:
+            pipe.sadd(key, *members)
+    pipe.set(loaded_key(user_id), 1)
+    await pipe.execute()
+
+
+async def ensure_loaded(*user_ids):
+    pipe = redis.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.exists(loaded_key(user_id))
+    for user_id, loaded in zip(user_ids, await pipe.execute()):
+        if not loaded:
+            await rebuild(user_id)
+
+
+async def relation(from_user_id, to_user_id):
+    await ensure_loaded(to_user_id)
+    pipe = redis.pipeline(transaction=False)
+    pipe.sismember(followers_key(to_user_id), str(from_user_id))
+    pipe.sismember(pending_key(to_user_id), str(from_user_id))
+    accepted, pending = await pipe.execute()
+    if accepted:
+        return ACCEPTED
+    if pending:
+        return PENDING
+    return None
+
+
+async def is_following(from_user_id, to_user_id):
+    await ensure_loaded(from_user_id)
+    return await redis.sismember(following_key(from_user_id), str(to_user_id))
+
+
+async def followings(user_id):
+    await ensure_loaded(user_id)
+    return await redis.smembers(following_key(user_id))
+
+
+async def followers(user_id):
+    await ensure_loaded(user_id)
+    return await redis.smembers(followers_key(user_id))
+
+
+async def follower_count(user_id):
+    await ensure_loaded(user_id)
+    return await redis.scard(followers_key(user_id))
+
+
+async def mutuals(user_id):
+    await ensure_loaded(user_id)
+    return await redis.sinter(following_key(user_id), followers_key(user_id))
+
+
+async def common_followings(user_id, other_id):
+    await ensure_loaded(user_id, other_id)
+    return await redis.sinter(following_key(user_id), following_key(other_id))
+
+
+async def following_in(user_id, key):
+    await ensure_loaded(user_id)
+    return await redis.sinter(following_key(user_id), key)
+
+
+async def follow(from_user_id, to_user_id, status):
+    await mongo.follows.insert_one({'from_user_id': ObjectId(from_user_id), 'to_user_id': ObjectId(to_user_id),
+                                    'status': status})
+    pipe = redis.pipeline()
+    if status == ACCEPTED:
+        pipe.sadd(following_key(from_user_id), str(to_user_id))
+        pipe.sadd(followers_key(to_user_id), str(from_user_id))
+    else:
+        pipe.sadd(pending_key(to_user_id), str(from_user_id))
+    await pipe.execute()
+
+
+async def accept(from_user_id, to_user_id):
+    res = await mongo.follows.update_one(
+        {'from_user_id': ObjectId(from_user_id), 'to_user_id': ObjectId(to_user_id), 'status': PENDING},
+        {'$set': {'status': ACCEPTED}},
+    )
+    if not res.modified_count:
+        return False
+    pipe = redis.pipeline()
+    pipe.srem(pending_key(to_user_id), str(from_user_id))
+    pipe.sadd(following_key(from_user_id), str(to_user_id))
+    pipe.sadd(followers_key(to_user_id), str(from_user_id))
+    await pipe.execute()
+    return True
+
+
+async def unfollow(from_user_id, to_user_id):
+    res = await mongo.follows.delete_one({'from_user_id': ObjectId(from_user_id),
+                                          'to_user_id': ObjectId(to_user_id)})
+    pipe = redis.pipeline()
+    pipe.srem(following_key(from_user_id), str(to_user_id))
+    pipe.srem(followers_key(to_user_id), str(from_user_id))
+    pipe.srem(pending_key(to_user_id), str(from_user_id))
+    await pipe.execute()
+    return bool(res.deleted_count)
+
+
+async def rebuild_all():
+    async for user in mongo.users.find({}, {'_id': 1}):
+        await rebuild(str(user['_id']))
+
+
+if __name__ == '__main__':
+    asyncio.run(rebuild_all())
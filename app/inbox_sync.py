@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+
+from app.database import redis, mongo
+
+logger = logging.getLogger(__name__)
+
+SEQ_COUNTER_ID = 'inbox_seq'
+CHANGES_CHANNEL_PREFIX = 'inbox:changes:'
+INFLIGHT_KEY_PREFIX = 'inbox:inflight:'
+INFLIGHT_TTL = 60
+BACKFILL_BATCH = 1000
+
+# 이 프로세스에서 롱폴링 중인 요청들. 구독은 프로세스당 하나만 연다
+_waiters = {}
+
+
+def changes_channel(phone):
+    return f'{CHANGES_CHANNEL_PREFIX}{phone}'
+
+
+async def next_seqs(count):
+    # Redis 가 비워져도 워터마크가 되돌아가지 않도록 시퀀스는 Mongo 에 둔다
+    counter = await mongo.counters.find_one_and_update(
+        {'_id': SEQ_COUNTER_ID}, {'$inc': {'value': count}}, upsert=True, return_document=ReturnDocument.AFTER,
+    )
+    return range(counter['value'] - count + 1, counter['value'] + 1)
+
+
+def inflight_key(phone):
+    return f'{INFLIGHT_KEY_PREFIX}{phone}'
+
+
+@asynccontextmanager
+async def allocate(phones, count):
+    # seq 를 발급받기 전에 진행 중으로 표시해야 먼저 발급된 seq 가 늦게 저장되어도 sync 가 건너뛰지 않는다
+    token = str(ObjectId())
+    members = [token]
+    keys = [inflight_key(phone) for phone in set(phones)]
+    deadline = time.time() + INFLIGHT_TTL
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.zadd(key, {token: deadline})
+        pipe.expire(key, INFLIGHT_TTL)
+    await pipe.execute()
+    try:
+        seqs = await next_seqs(count)
+        # 발급된 가장 작은 seq 를 남겨 두어 그 앞까지는 계속 sync 할 수 있게 한다
+        members.append(f'{token}:{seqs[0]}')
+        pipe = redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.zadd(key, {members[1]: deadline})
+            pipe.zrem(key, token)
+        await pipe.execute()
+        yield seqs
+    finally:
+        pipe = redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrem(key, *members)
+        await pipe.execute()
+
+
+async def visible_seq(phone):
+    # 이 값 이하의 seq 는 모두 저장이 끝났다. 카운터를 먼저 읽어야 그 뒤에 표시된 항목만 남는다
+    counter = await mongo.counters.find_one({'_id': SEQ_COUNTER_ID})
+    key = inflight_key(phone)
+    pipe = redis.pipeline(transaction=False)
+    pipe.zremrangebyscore(key, '-inf', time.time())
+    pipe.zrange(key, 0, -1)
+    _, members = await pipe.execute()
+
+    visible = counter['value'] if counter else 0
+    for member in members:
+        _, _, seq = member.partition(':')
+        if not seq:
+            # 아직 발급 중인 seq 는 카운터보다 작을 수도 있다
+            return 0
+        visible = min(visible, int(seq) - 1)
+    return visible
+
+
+async def notify(phones):
+    pipe = redis.pipeline(transaction=False)
+    for phone in phones:
+        pipe.publish(changes_channel(phone), 1)
+    await pipe.execute()
+
+
+async def insert_entries(docs, ordered=True, atomic=False):
+    phones = {doc['phone'] for doc in docs}
+    try:
+        async with allocate(phones, len(docs)) as seqs:
+            for doc, seq in zip(docs, seqs):
+                doc['seq'] = seq
+                doc.setdefault('read', False)
+            try:
+                return await mongo.inbox.insert_many(docs, ordered=ordered)
+            except Exception:
+                if atomic:
+                    # 진행 중 표시가 남아 있는 동안 되돌려야 sync 가 되돌릴 항목을 내보내지 않는다
+                    await mongo.inbox.delete_many({'_id': {'$in': [doc['_id'] for doc in docs if '_id' in doc]}})
+                    phones = set()
+                raise
+    finally:
+        # 일부만 저장된 경우에도 깨워서 다시 조회하게 한다
+        if phones:
+            await notify(phones)
+
+
+async def mark_read(phone, inbox_ids):
+    if not inbox_ids:
+        return 0
+    async with allocate([phone], len(inbox_ids)) as seqs:
+        res = await mongo.inbox.bulk_write([
+            UpdateOne({'_id': inbox_id, 'phone': phone, 'read': {'$ne': True}}, {'$set': {'read': True, 'seq': seq}})
+            for inbox_id, seq in zip(inbox_ids, seqs)
+        ], ordered=False)
+    if res.modified_count:
+        await notify([phone])
+    return res.modified_count
+
+
+async def changes(phone, since, limit):
+    visible = await visible_seq(phone)
+    if visible <= since:
+        return []
+    return await mongo.inbox.find({'phone': phone, 'seq': {'$gt': since, '$lte': visible}}) \
+        .sort('seq', 1).to_list(limit)
+
+
+@contextmanager
+def watch(phone):
+    event = asyncio.Event()
+    _waiters.setdefault(phone, set()).add(event)
+    try:
+        yield event
+    finally:
+        _waiters[phone].discard(event)
+        if not _waiters[phone]:
+            del _waiters[phone]
+
+
+async def run_listener():
+    while True:
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.psubscribe(f'{CHANGES_CHANNEL_PREFIX}*')
+            async for message in pubsub.listen():
+                if message['type'] != 'pmessage':
+                    continue
+                for event in _waiters.get(message['channel'][len(CHANGES_CHANNEL_PREFIX):], ()):
+                    event.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('인박스 변경 구독 실패')
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+
+async def backfill():
+    # seq 가 없는 기존 항목에 시퀀스를 부여한다
+    while True:
+        docs = await mongo.inbox.find({'seq': {'$exists': False}}, {'_id': 1}).to_list(BACKFILL_BATCH)
+        if not docs:
+            return
+        await mongo.inbox.bulk_write([
+            UpdateOne({'_id': doc['_id'], 'seq': {'$exists': False}}, {'$set': {'seq': seq}})
+            for doc, seq in zip(docs, await next_seqs(len(docs)))
+        ], ordered=False)
+
+
+if __name__ == '__main__':
+    asyncio.run(backfill())
@@ -0,0 +1,175 @@
+import asyncio
+
+from pymongo import ASCENDING, DESCENDING, IndexModel, monitoring
+
+INDEXES = {
+    'users': [
+        IndexModel([('phone', ASCENDING)], unique=True),
+        IndexModel([('phone_hash', ASCENDING)]),
+    ],
+    'follows': [
+        IndexModel([('from_user_id', ASCENDING), ('to_user_id', ASCENDING)], unique=True),
+        IndexModel([('from_user_id', ASCENDING), ('status', ASCENDING)]),
+        IndexModel([('to_user_id', ASCENDING), ('status', ASCENDING)]),
+        IndexModel([('from_user_id', ASCENDING), ('_id', DESCENDING)]),
+        IndexModel([('to_user_id', ASCENDING), ('_id', DESCENDING)]),
+    ],
+    'posts': [
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)]),
+    ],
+    'likes': [
+        IndexModel([('user_id', ASCENDING), ('post_id', ASCENDING)], unique=True),
+        IndexModel([('post_id', ASCENDING), ('_id', DESCENDING)]),
+    ],
+    'comments': [
+        IndexModel([('post_id', ASCENDING), ('created_at', ASCENDING), ('_id', ASCENDING)]),
+        IndexModel([('user_id', ASCENDING)]),
+    ],
+    'deletion_jobs': [
+        IndexModel([('locked_until', ASCENDING)]),
+    ],
+    'inbox': [
+        IndexModel([('phone', ASCENDING), ('_id', DESCENDING)]),
+        IndexModel([('phone', ASCENDING), ('seq', ASCENDING)]),
+        IndexModel([('idempotency_key', ASCENDING)], unique=True,
+                   partialFilterExpression={'idempotency_key': {'$type': 'string'}}),
+    ],
+}
+
+
+def _shape(value):
+    # 값은 버리고 필드와 연산자 구조만 남긴다
+    if isinstance(value, dict):
+        return tuple(sorted((key, _shape(item)) for key, item in value.items()))
+    if isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+        return tuple(_shape(item) for item in value)
+    return None
+
+
+def _fields(query):
+    # 동등 조건 필드, 범위 조건 필드, $or 분기 목록
+    equality, ranges, branches = set(), set(), []
+    for key, value in query.items():
+        if key == '$and':
+            for sub_query in value:
+                sub_equality, sub_ranges, sub_branches = _fields(sub_query)
+                equality |= sub_equality
+                ranges |= sub_ranges
+                branches += sub_branches
+        elif key == '$or':
+            branches.append(value)
+        elif key.startswith('$'):
+            continue
+        elif isinstance(value, dict) and any(op.startswith('$') for op in value) \
+                and not set(value) <= {'$eq', '$in'}:
+            ranges.add(key)
+        else:
+            equality.add(key)
+    return equality, ranges, branches
+
+
+def _covers(keys, equality, ranges, sort):
+    if not sort:
+        return keys[0][0] in equality | ranges
+    # 동등 조건 필드로 채운 앞부분 다음 키들이 정렬 순서와 같아야 메모리 정렬(SORT)을 하지 않는다
+    prefix = 0
+    while prefix < len(keys) and keys[prefix][0] in equality:
+        prefix += 1
+    rest = keys[prefix:prefix + len(sort)]
+    if [field for field, _ in rest] != [field for field, _ in sort]:
+        return False
+    # 인덱스는 양방향으로 스캔할 수 있다
+    same = all(a == b for (_, a), (_, b) in zip(rest, sort))
+    reverse = all(a == -b for (_, a), (_, b) in zip(rest, sort))
+    return same or reverse
+
+
+def is_indexed(collection, query, sort=()):
+    keys = [[('_id', ASCENDING)]] + [list(index.document['key'].items()) for index in INDEXES.get(collection, [])]
+    equality, ranges, branches = _fields(query)
+    if any(_covers(index_keys, equality, ranges, sort) for index_keys in keys):
+        return True
+    # 최상위 조건으로 인덱스를 못 쓰면 $or 의 모든 분기가 인덱스를 써야 한다
+    return any(all(is_indexed(collection, {'$and': [branch, {field: None for field in equality}]}, sort)
+                   for branch in branch_list) for branch_list in branches)
+
+
+def _sort(sort):
+    return tuple((sort or {}).items())
+
+
+def _command_queries(command_name, command):
+    # (조건, 정렬) 목록
+    if command_name == 'find':
+        return [(command.get('filter', {}), _sort(command.get('sort')))]
+    if command_name == 'findAndModify':
+        return [(command.get('query', {}), _sort(command.get('sort')))]
+    if command_name in ('count', 'distinct'):
+        return [(command.get('query', {}), ())]
+    if command_name == 'update':
+        return [(update['q'], ()) for update in command.get('updates', [])]
+    if command_name == 'delete':
+        return [(delete['q'], ()) for delete in command.get('deletes', [])]
+    if command_name == 'aggregate':
+        pipeline = command.get('pipeline', [])
+        query = pipeline[0]['$match'] if pipeline and '$match' in pipeline[0] else {}
+        stages = pipeline[1:] if query else pipeline
+        sort = _sort(stages[0]['$sort']) if stages and '$sort' in stages[0] else ()
+        return [(query, sort)]
+    return []
+
+
+def _lookup_queries(pipeline):
+    for stage in pipeline:
+        lookup = stage.get('$lookup', {})
+        if 'foreignField' in lookup:
+            yield lookup['from'], {lookup['foreignField']: None}
+
+
+class QueryRecorder(monitoring.CommandListener):
+    # 실제로 실행된 쿼리와 정렬을 모아 인덱스를 쓰는지 확인한다
+    def __init__(self):
+        self.queries = {}
+
+    def record(self, collection, query, sort=()):
+        sort = tuple(sort)
+        self.queries.setdefault((collection, _shape(query), sort), (collection, query, sort))
+
+    def record_pipeline(self, collection, pipeline):
+        self.record(collection, *_command_queries('aggregate', {'pipeline': pipeline})[0])
+        for lookup_collection, query in _lookup_queries(pipeline):
+            self.record(lookup_collection, query)
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == 'aggregate':
+            self.record_pipeline(collection, event.command.get('pipeline', []))
+            return
+        for query, sort in _command_queries(event.command_name, event.command):
+            self.record(collection, query, sort)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def uncovered(self):
+        return [(collection, query, sort) for collection, query, sort in self.queries.values()
+                if not is_indexed(collection, query, sort)]
+
+
+async def create_indexes(mongo):
+    for collection, indexes in INDEXES.items():
+        await mongo[collection].create_indexes(indexes)
+
+
+async def main():
+    from app import database
+
+    await create_indexes(database.mongo)
+    await database.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
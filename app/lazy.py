@@ -0,0 +1,38 @@
+import os
+
+_instances = []
+
+
+# 첫 사용 시점에 factory 로 클라이언트를 만들고, fork 된 자식 프로세스에서는 다시 만든다
+class LazyClient:
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        _instances.append(self)
+
+    @property
+    def loaded(self):
+        return self._client is not None
+
+    def get(self):
+        if self._client is None:
+            self._client = self._factory()
+        return self._client
+
+    def reset(self):
+        self._client = None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __getitem__(self, name):
+        return self.get()[name]
+
+
+def _reset_all():
+    # 부모의 소켓과 이벤트 루프를 자식이 공유하지 않도록 한다
+    for instance in _instances:
+        instance.reset()
+
+
+os.register_at_fork(after_in_child=_reset_all)
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+
+from bson import ObjectId
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from redis.commands.core import AsyncScript
+
+from app.database import redis, mongo
+
+logger = logging.getLogger(__name__)
+
+BUFFER_KEY = 'likes:buffer'
+FLUSHING_KEY = 'likes:buffer:flushing'
+FLUSH_LOCK_KEY = 'likes:buffer:lock'
+FLUSH_LOCK_TTL = 60
+FLUSH_INTERVAL = 2
+FLUSH_BATCH = 1000
+DUPLICATE_KEY = 11000
+LIKED = '1'
+UNLIKED = '0'
+
+# (user_id, post_id) 별 마지막 상태만 남긴다. 이전 상태를 돌려주어 카운터를 바꿀지 판단한다.
+# 버퍼에 없고 ARGV[3] 도 비어 있으면 nil 을 돌려주고, 호출 측이 Mongo 상태를 넣어 다시 호출한다
+SET_STATE = AsyncScript(redis, b"""
+local prev = redis.call('HGET', KEYS[1], ARGV[1]) or redis.call('HGET', KEYS[2], ARGV[1])
+if not prev then
+    if ARGV[3] == '' then
+        return false
+    end
+    prev = ARGV[3]
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return prev
+""")
+
+
+def pair_key(user_id, post_id):
+    return f'{user_id}:{post_id}'
+
+
+async def set_state(user_id, post_id, liked):
+    field = pair_key(user_id, post_id)
+    state = LIKED if liked else UNLIKED
+    prev = await SET_STATE(keys=[BUFFER_KEY, FLUSHING_KEY], args=[field, state, ''])
+    if prev is None:
+        stored = await mongo.likes.find_one({'user_id': user_id, 'post_id': ObjectId(post_id)}, {'_id': 1})
+        prev = await SET_STATE(keys=[BUFFER_KEY, FLUSHING_KEY], args=[field, state, LIKED if stored else UNLIKED])
+    return prev != state
+
+
+async def buffered_state(user_id, post_id):
+    field = pair_key(user_id, post_id)
+    pipe = redis.pipeline(transaction=False)
+    pipe.hget(BUFFER_KEY, field)
+    pipe.hget(FLUSHING_KEY, field)
+    state, flushing = await pipe.execute()
+    return state or flushing
+
+
+async def has_pending(user_id):
+    for key in (BUFFER_KEY, FLUSHING_KEY):
+        async for _ in redis.hscan_iter(key, match=f'{user_id}:*'):
+            return True
+    return False
+
+
+async def _apply(entries):
+    pairs = [(*field.split(':'), state) for field, state in entries]
+    # 버퍼에 있는 동안 삭제된 게시물에는 좋아요를 만들지 않는다
+    posts = mongo.posts.find({'_id': {'$in': list({ObjectId(post_id) for _, post_id, _ in pairs})}}, {'_id': 1})
+    existing = {str(post['_id']) async for post in posts}
+
+    requests = []
+    for user_id, post_id, state in pairs:
+        query = {'user_id': user_id, 'post_id': ObjectId(post_id)}
+        if state == UNLIKED:
+            requests.append(DeleteOne(query))
+        elif post_id in existing:
+            requests.append(UpdateOne(query, {'$set': query}, upsert=True))
+    if not requests:
+        return
+    try:
+        await mongo.likes.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+            raise
+
+
+async def flush():
+    if not await redis.set(FLUSH_LOCK_KEY, 1, nx=True, ex=FLUSH_LOCK_TTL):
+        return 0
+    try:
+        # 이전 flush 가 중단되어 남은 항목이 있으면 먼저 반영한다
+        if not await redis.exists(FLUSHING_KEY):
+            if not await redis.exists(BUFFER_KEY):
+                return 0
+            await redis.rename(BUFFER_KEY, FLUSHING_KEY)
+        entries = list((await redis.hgetall(FLUSHING_KEY)).items())
+        for i in range(0, len(entries), FLUSH_BATCH):
+            await _apply(entries[i:i + FLUSH_BATCH])
+        await redis.delete(FLUSHING_KEY)
+        return len(entries)
+    finally:
+        await redis.delete(FLUSH_LOCK_KEY)
+
+
+async def run_flusher():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await flush()
+        except Exception:
+            logger.exception('좋아요 flush 실패')
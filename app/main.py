@@ -1,13 +1,48 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.routers import auth, user, inbox, post, subscription
+from app import cache, database, counters, deletion, inbox_sync, like_buffer, metrics, trending, uploads
+from app.indexes import create_indexes
+from app.routers import auth, user, inbox, post, subscription, trending as trending_router
 
 load_dotenv()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await database.connect()
+    await create_indexes(database.mongo)
+    # 준비 완료 전에 커넥션 풀, 업로드 풀, OpenAPI 스키마를 미리 채운다
+    await database.warmup()
+    await uploads.refill()
+    app.openapi()
+    flusher = asyncio.create_task(counters.run_flusher())
+    like_flusher = asyncio.create_task(like_buffer.run_flusher())
+    refiller = asyncio.create_task(uploads.run_refiller())
+    listener = asyncio.create_task(inbox_sync.run_listener())
+    deleter = asyncio.create_task(deletion.run_worker())
+    compactor = asyncio.create_task(trending.run_compactor())
+    yield
+    compactor.cancel()
+    deleter.cancel()
+    listener.cancel()
+    refiller.cancel()
+    like_flusher.cancel()
+    flusher.cancel()
+    await like_buffer.flush()
+    await counters.flush()
+    await database.close()
+
+
 app = FastAPI(
     title="MyCut4Cut API",
     docs_url="/",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -18,8 +53,48 @@ app.add_middleware(
     allow_headers=['*'],
 )
 
+
+@app.middleware('http')
+async def cache_stats(request: Request, call_next):
+    stats = cache.start_request()
+    response = await call_next(request)
+    response.headers['X-Cache'] = cache.format_stats(stats)
+    return response
+
+
+@app.middleware('http')
+async def instrument(request: Request, call_next):
+    calls = metrics.start_request()
+    start = time.perf_counter()
+    # 핸들러가 예외를 던지면 call_next 도 예외를 던지므로 500 으로 기록한다
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        duration = time.perf_counter() - start
+        # 라벨 수가 늘지 않도록 실제 경로 대신 라우트 경로 템플릿을 쓴다
+        route = request.scope.get('route')
+        metrics.observe_request(request.method, route.path if route else 'unmatched', status, duration)
+    if request.headers.get(metrics.PROFILE_HEADER):
+        response.headers['Server-Timing'] = metrics.format_profile(calls, duration)
+    return response
+
+
+@app.get('/health', include_in_schema=False)
+async def health():
+    return {'message': 'success'}
+
+
+@app.get('/metrics', include_in_schema=False)
+async def get_metrics():
+    content, media_type = metrics.export()
+    return Response(content, media_type=media_type)
+
+
 app.include_router(auth.router)
 app.include_router(user.router)
 app.include_router(inbox.router)
 app.include_router(post.router)
 app.include_router(subscription.router)
+app.include_router(trending_router.router)
@@ -0,0 +1,111 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest,
+                               multiprocess, start_http_server)
+from pymongo import monitoring
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+
+PROFILE_HEADER = 'X-Profile'
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ['method', 'route', 'status'])
+DB_LATENCY = Histogram('db_command_duration_seconds', 'Mongo/Redis round-trip latency', ['db', 'command'])
+EXTERNAL_LATENCY = Histogram('external_call_duration_seconds', 'External API latency', ['service', 'operation'])
+
+# 요청별 (종류, 소요 시간) 목록. Motor 는 executor 로 컨텍스트를 복사하므로 같은 리스트에 기록된다
+_request_calls = ContextVar('request_calls', default=None)
+
+
+def start_request():
+    calls = []
+    _request_calls.set(calls)
+    return calls
+
+
+def observe_request(method, route, status, duration):
+    REQUEST_LATENCY.labels(method, route, status).observe(duration)
+
+
+def _record(kind, duration):
+    calls = _request_calls.get()
+    if calls is not None:
+        calls.append((kind, duration))
+
+
+def observe_db(db, command, duration):
+    DB_LATENCY.labels(db, command).observe(duration)
+    _record(db, duration)
+
+
+@contextmanager
+def timed(service, operation):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        EXTERNAL_LATENCY.labels(service, operation).observe(duration)
+        _record(service, duration)
+
+
+def format_profile(calls, duration):
+    totals = {}
+    for kind, call_duration in calls:
+        count, total = totals.get(kind, (0, 0))
+        totals[kind] = (count + 1, total + call_duration)
+    timings = [f'{kind};dur={total * 1000:.2f};desc="{count} calls"' for kind, (count, total) in totals.items()]
+    timings.append(f'total;dur={duration * 1000:.2f}')
+    return ', '.join(timings)
+
+
+def _registry():
+    # 여러 워커로 띄운 경우 모든 워커의 값을 합쳐서 내보낸다
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def export():
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+
+def serve(port):
+    # API 서버와 따로 도는 프로세스(SMS 워커)는 자체 포트로 /metrics 를 노출한다
+    start_http_server(port, registry=_registry())
+
+
+class MongoListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        observe_db('mongo', event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        observe_db('mongo', event.command_name, event.duration_micros / 1e6)
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            observe_db('redis', 'PIPELINE', time.perf_counter() - start)
+
+
+class InstrumentedRedis(Redis):
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            observe_db('redis', str(args[0]).upper(), time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
@@ -0,0 +1,73 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from typing import Optional
+
+from bson import ObjectId
+from fastapi import HTTPException, Query
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+def page_params(cursor: Optional[str] = None, limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT)):
+    return {'cursor': cursor, 'limit': limit}
+
+
+def encode_cursor(doc, sort_key='_id'):
+    data = {'id': str(doc['_id'])}
+    if sort_key != '_id':
+        data['key'] = doc[sort_key].isoformat()
+    return urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(cursor, sort_key='_id'):
+    try:
+        data = json.loads(urlsafe_b64decode(cursor.encode()))
+        key = datetime.fromisoformat(data['key']) if sort_key != '_id' else None
+        return key, ObjectId(data['id'])
+    except Exception:
+        raise HTTPException(status_code=400, detail='잘못된 커서입니다.')
+
+
+def cursor_filter(cursor, sort_key='_id', descending=True):
+    key, _id = decode_cursor(cursor, sort_key)
+    op = '$lt' if descending else '$gt'
+    if sort_key == '_id':
+        return {'_id': {op: _id}}
+    return {'$or': [
+        {sort_key: {op: key}},
+        {sort_key: key, '_id': {op: _id}},
+    ]}
+
+
+def make_page(docs, limit, sort_key='_id'):
+    if len(docs) <= limit:
+        return docs, None
+    docs = docs[:limit]
+    return docs, encode_cursor(docs[-1], sort_key)
+
+
+def _page_query(query, cursor, sort_key, descending):
+    if cursor:
+        query = {'$and': [query, cursor_filter(cursor, sort_key, descending)]}
+    direction = -1 if descending else 1
+    sort = [('_id', direction)] if sort_key == '_id' else [(sort_key, direction), ('_id', direction)]
+    return query, sort
+
+
+def find_page(collection, query, cursor=None, sort_key='_id', descending=True, projection=None):
+    query, sort = _page_query(query, cursor, sort_key, descending)
+    return collection.find(query, projection).sort(sort)
+
+
+async def paginate(collection, query, cursor=None, limit=DEFAULT_LIMIT, sort_key='_id', descending=True,
+                   projection=None, lookup=None):
+    if lookup is None:
+        docs = await find_page(collection, query, cursor, sort_key, descending, projection) \
+            .limit(limit + 1).to_list(None)
+    else:
+        query, sort = _page_query(query, cursor, sort_key, descending)
+        pipeline = [{'$match': query}, {'$sort': dict(sort)}, {'$limit': limit + 1}, *lookup]
+        docs = await collection.aggregate(pipeline).to_list(None)
+    return make_page(docs, limit, sort_key)
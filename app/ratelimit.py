@@ -0,0 +1,122 @@
+import logging
+import math
+import time
+
+from fastapi import Depends, HTTPException, Request, status
+from redis.commands.core import AsyncScript
+
+from app.cache import LRUCache
+from app.database import redis
+from app.dependencies import get_current_user
+
+logger = logging.getLogger(__name__)
+
+IP = 'ip'
+USER = 'user'
+PHONE = 'phone'
+
+# 토큰 버킷: limit 개까지 몰아서 허용하고 period 동안 limit 개가 다시 채워진다
+# 여러 버킷을 한 번에 확인하고, 모두 토큰이 있을 때만 차감한다. 키마다 retry_after 를 돌려준다
+# import 시점에 Redis 클라이언트를 만들지 않도록 bytes 로 직접 생성한다
+TOKEN_BUCKET = AsyncScript(redis, b"""
+local now = tonumber(ARGV[1])
+local buckets = {}
+local allowed = true
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    buckets[i] = {capacity, rate, tokens}
+    if tokens < 1 then
+        allowed = false
+    end
+end
+local retry_after = {}
+for i, key in ipairs(KEYS) do
+    local capacity, rate, tokens = buckets[i][1], buckets[i][2], buckets[i][3]
+    retry_after[i] = '0'
+    if tokens < 1 then
+        retry_after[i] = tostring((1 - tokens) / rate)
+    elseif allowed then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return retry_after
+""")
+
+# 거절된 키는 retry_after 동안 Redis 를 거치지 않고 바로 거절한다
+blocked = LRUCache(10000, 1)
+
+
+def rate_limit_key(name, identity):
+    return f'ratelimit:{name}:{identity}'
+
+
+def _reject(retry_after):
+    raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail='잠시 후 다시 시도해주세요.',
+                        headers={'Retry-After': str(math.ceil(retry_after))})
+
+
+async def check(rules):
+    # rules: (name, identity, limit, period) 목록
+    keys = [rate_limit_key(name, identity) for name, identity, _, _ in rules]
+    for key in keys:
+        blocked_until = blocked.get(key)
+        if blocked_until is not None:
+            _reject(blocked_until - time.time())
+
+    args = [time.time()]
+    for _, _, limit, period in rules:
+        args += [limit, limit / period]
+    try:
+        retry_after = [float(value) for value in await TOKEN_BUCKET(keys=keys, args=args)]
+    except Exception:
+        # Redis 장애 시에는 요청을 막지 않는다
+        logger.warning('rate limit 확인 실패', exc_info=True)
+        return
+    if max(retry_after) > 0:
+        for key, key_retry_after in zip(keys, retry_after):
+            if key_retry_after > 0:
+                blocked.set(key, time.time() + key_retry_after, ttl=key_retry_after)
+        _reject(max(retry_after))
+
+
+def client_ip(request: Request):
+    return request.client.host if request.client else 'unknown'
+
+
+async def _identity(key, request, current_user):
+    if key == USER:
+        return current_user['_id']
+    if key == PHONE:
+        try:
+            phone = (await request.json()).get('phone')
+        except Exception:
+            phone = None
+        return phone or client_ip(request)
+    return client_ip(request)
+
+
+def rate_limits(*rules):
+    # rules: (name, limit, period, key) 목록. 한 번의 Redis 호출로 모두 확인한다
+    async def _check(request, current_user=None):
+        await check([(name, await _identity(key, request, current_user), limit, period)
+                     for name, limit, period, key in rules])
+
+    if any(key == USER for _, _, _, key in rules):
+        async def dependency(request: Request, current_user: dict = Depends(get_current_user)):
+            await _check(request, current_user)
+    else:
+        async def dependency(request: Request):
+            await _check(request)
+
+    return Depends(dependency)
+
+
+def rate_limit(name, limit, period, key=IP):
+    return rate_limits((name, limit, period, key))
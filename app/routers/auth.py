@@ -4,14 +4,22 @@ from random import randint
 from fastapi import APIRouter, HTTPException, status
 from jose import jwt
 from pydantic import BaseModel, Field
+from pymongo import ReturnDocument
 
-from app.aws_client import sns_client
+from app import cache, ratelimit, sms
+from app.contacts import phone_hash
 from app.config import config
 from app.database import redis, mongo
+from app.dependencies import get_token_version
+from app.encoding import BSONRoute
+
+AUTH_CODE_TTL = 60 * 5
+AUTH_CODE_RESEND_INTERVAL = 60
 
 router = APIRouter(
     prefix='/auth',
     tags=['auth'],
+    route_class=BSONRoute,
 )
 
 
@@ -19,14 +27,16 @@ class UserPhone(BaseModel):
     phone: str = Field(examples=['01012345678'], min_length=11, max_length=11)
 
 
-@router.post('/phone')
-def send_auth_code(user_phone: UserPhone):
+@router.post('/phone', dependencies=[ratelimit.rate_limits(('auth_phone', 5, 60 * 60, ratelimit.PHONE),
+                                                           ('auth_phone_ip', 30, 60 * 60, ratelimit.IP))])
+async def send_auth_code(user_phone: UserPhone):
+    key = f"phoneauth:{user_phone.phone}"
+    if await redis.ttl(key) > AUTH_CODE_TTL - AUTH_CODE_RESEND_INTERVAL:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail='잠시 후 다시 시도해주세요.')
+
     code = randint(100000, 999999)
-    redis.set(f"phoneauth:{user_phone.phone}", code, ex=60 * 5)
-    sns_client.publish(
-        PhoneNumber=f"+82{user_phone.phone[1:]}",
-        Message=f'[내컷네컷] 인증번호는 {code} 입니다.'
-    )
+    await redis.set(key, code, ex=AUTH_CODE_TTL)
+    await sms.enqueue(f"+82{user_phone.phone[1:]}", f'[내컷네컷] 인증번호는 {code} 입니다.')
 
     return {'message': 'success'}
 
@@ -37,23 +47,26 @@ class UserAuth(BaseModel):
     code: str = Field(examples=['123456'], min_length=6, max_length=6)
 
 
-@router.post('/verify')
-def verify_auth_code(user_auth: UserAuth):
-    if redis.get(f"phoneauth:{user_auth.phone}") == user_auth.code:
-        redis.delete(f"phoneauth:{user_auth.phone}")
-        mongo.users.update_one({'phone': user_auth.phone}, {'$set': {
+@router.post('/verify', dependencies=[ratelimit.rate_limit('auth_verify', 10, 60 * 5, key=ratelimit.PHONE)])
+async def verify_auth_code(user_auth: UserAuth):
+    if await redis.get(f"phoneauth:{user_auth.phone}") == user_auth.code:
+        await redis.delete(f"phoneauth:{user_auth.phone}")
+        user = await mongo.users.find_one_and_update({'phone': user_auth.phone}, {'$set': {
             'name': user_auth.name,
             'phone': user_auth.phone,
-        }}, upsert=True)
-
-        res = mongo.users.find_one({'phone': user_auth.phone})
-        res['_id'] = str(res['_id'])
-        res.update({
+            'phone_hash': phone_hash(user_auth.phone),
+        }}, projection={'_id': 1}, upsert=True, return_document=ReturnDocument.AFTER)
+        user_id = str(user['_id'])
+        await cache.invalidate_user(user_id)
+        claims = {
+            '_id': user_id,
+            'phone': user_auth.phone,
+            'ver': await get_token_version(user_id),
             'iat': int(datetime.now().timestamp()),
-            'exp': int((datetime.now() + timedelta(days=30)).timestamp())
-        })
+            'exp': int((datetime.now() + timedelta(days=30)).timestamp()),
+        }
 
-        token = jwt.encode(res, config['JWT_SECRET'], algorithm="HS256")
+        token = jwt.encode(claims, config['JWT_SECRET'], algorithm="HS256")
         return {'message': 'success', 'token': token}
     else:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='인증번호가 일치하지 않습니다.')
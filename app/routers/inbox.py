@@ -1,30 +1,30 @@
-from uuid import uuid4
+import asyncio
+import json
+from typing import Optional
 
-from fastapi import APIRouter, Depends
-from pydantic import BaseModel, Field
+from bson import ObjectId
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from pydantic import BaseModel, Field, ValidationError
+from pymongo.errors import BulkWriteError
 
-from app.aws_client import s3_client
+from app import inbox_sync, ratelimit, sns, uploads
+from app.config import config
 from app.database import mongo
 from app.dependencies import get_current_user
+from app.encoding import BSONRoute
+from app.pagination import MAX_LIMIT, page_params, paginate, find_page
+from app.streaming import STREAM_BATCH_SIZE, stream_mode, ndjson_response
 
 router = APIRouter(
     prefix='/inbox',
     tags=['inbox'],
+    route_class=BSONRoute,
 )
 
 
 @router.get('/s3_presigned_url')
-def get_s3_presigned_url():
-    res = s3_client.generate_presigned_post(
-        Bucket='w0nd3rwa11',
-        Key=f'images_{uuid4()}',
-        ExpiresIn=60 * 5,
-        Fields={
-            'acl': 'public-read',
-            'Content-Type': 'image/'
-        },
-    )
-    return res
+async def get_s3_presigned_url():
+    return await uploads.take_grant()
 
 
 class InboxNew(BaseModel):
@@ -33,13 +33,137 @@ class InboxNew(BaseModel):
     location: str = Field(examples=['인생네컷 판교디지털센터 특별점'])
 
 
-@router.post('/')
-def new_inbox(inbox_new: InboxNew):
-    mongo.inbox.insert_one(inbox_new.model_dump())
+@router.post('/', dependencies=[ratelimit.rate_limit('inbox_new', 120, 60)])
+async def new_inbox(inbox_new: InboxNew):
+    await inbox_sync.insert_entries([inbox_new.model_dump()])
     return {'message': 'success'}
 
 
+INBOX_BATCH_MAX = 500
+DUPLICATE_KEY = 11000
+
+
+class InboxBatchItem(InboxNew):
+    idempotency_key: Optional[str] = Field(default=None, max_length=128)
+
+
+class InboxBatch(BaseModel):
+    # 항목별로 검증 결과를 돌려주기 위해 개별 항목은 핸들러에서 검증한다
+    items: list[dict] = Field(max_length=INBOX_BATCH_MAX)
+
+
+@router.post('/batch', dependencies=[ratelimit.rate_limit('inbox_batch', 30, 60)])
+async def new_inbox_batch(inbox_batch: InboxBatch):
+    results = [None] * len(inbox_batch.items)
+    docs, indexes = [], []
+    for index, item in enumerate(inbox_batch.items):
+        try:
+            doc = InboxBatchItem.model_validate(item).model_dump(exclude_none=True)
+        except ValidationError as e:
+            results[index] = {'status': 'invalid', 'detail': e.errors(include_url=False, include_context=False)}
+            continue
+        docs.append(doc)
+        indexes.append(index)
+
+    failed = {}
+    if docs:
+        try:
+            await inbox_sync.insert_entries(docs, ordered=False)
+        except BulkWriteError as e:
+            failed = {error['index']: error for error in e.details['writeErrors']}
+
+    for doc_index, index in enumerate(indexes):
+        error = failed.get(doc_index)
+        if error is None:
+            results[index] = {'status': 'created'}
+        elif error['code'] == DUPLICATE_KEY:
+            # 이미 저장된 항목이므로 키오스크는 성공으로 보고 큐에서 지워도 된다
+            results[index] = {'status': 'duplicate'}
+        else:
+            results[index] = {'status': 'error', 'detail': error['errmsg']}
+
+    return {'message': 'success', 'results': results}
+
+
+class InboxUpload(BaseModel):
+    phone: str = Field(examples=['01012345678'], min_length=11, max_length=11)
+    location: str = Field(examples=['인생네컷 판교디지털센터 특별점'])
+
+
+@router.post('/upload', dependencies=[ratelimit.rate_limit('inbox_upload', 120, 60)])
+async def start_upload(inbox_upload: InboxUpload):
+    # 업로드가 끝나면 S3 이벤트로 인박스가 생성되므로 키오스크는 이 호출 한 번만 하면 된다
+    return await uploads.start_upload(inbox_upload.phone, inbox_upload.location)
+
+
+@router.post('/upload/complete')
+async def complete_upload(request: Request):
+    # S3 이벤트 알림은 SNS 토픽을 거쳐 HTTP 구독으로 전달되므로 SNS 서명으로 확인한다
+    try:
+        message = json.loads(await request.body())
+        await sns.verify(message, config.get('UPLOAD_TOPIC_ARN'))
+    except (ValueError, AttributeError, sns.InvalidMessage):
+        raise HTTPException(status_code=401, detail='Invalid signature')
+
+    if message['Type'] == 'SubscriptionConfirmation':
+        await sns.confirm(message)
+        return {'message': 'success', 'created': 0}
+    if message['Type'] != 'Notification':
+        return {'message': 'success', 'created': 0}
+
+    created = 0
+    for key in uploads.event_keys(json.loads(message['Message'])):
+        created += await uploads.complete_upload(key)
+    return {'message': 'success', 'created': created}
+
+
 @router.get('/')
-def get_inbox(current_user: dict = Depends(get_current_user)):
-    inbox = mongo.inbox.find({'phone': current_user['phone']}, {'_id': 0})
-    return {'inbox': list(inbox)}
+async def get_inbox(page: dict = Depends(page_params), stream: bool = Depends(stream_mode),
+                    current_user: dict = Depends(get_current_user)):
+    if stream:
+        inbox = find_page(mongo.inbox, {'phone': current_user['phone']}, page['cursor'])
+        return ndjson_response(inbox.batch_size(STREAM_BATCH_SIZE), transform=lambda item: item.pop('_id'))
+
+    inbox, next_cursor = await paginate(mongo.inbox, {'phone': current_user['phone']}, **page)
+    for item in inbox:
+        del item['_id']
+    return {'inbox': inbox, 'next_cursor': next_cursor}
+
+
+INBOX_SYNC_MAX_WAIT = 30
+
+
+@router.get('/sync')
+async def sync_inbox(since: int = Query(0, ge=0), limit: int = Query(MAX_LIMIT, ge=1, le=MAX_LIMIT),
+                     wait: int = Query(0, ge=0, le=INBOX_SYNC_MAX_WAIT),
+                     current_user: dict = Depends(get_current_user)):
+    phone = current_user['phone']
+    # 조회 전에 먼저 등록해야 조회와 대기 사이의 변경을 놓치지 않는다
+    with inbox_sync.watch(phone) as changed:
+        inbox = await inbox_sync.changes(phone, since, limit + 1)
+        if not inbox and wait:
+            try:
+                await asyncio.wait_for(changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                inbox = await inbox_sync.changes(phone, since, limit + 1)
+
+    has_more = len(inbox) > limit
+    inbox = inbox[:limit]
+    return {'inbox': inbox, 'since': inbox[-1]['seq'] if inbox else since, 'has_more': has_more}
+
+
+class InboxRead(BaseModel):
+    inbox_ids: list[str] = Field(max_length=MAX_LIMIT)
+
+
+@router.post('/read')
+async def read_inbox(inbox_read: InboxRead, current_user: dict = Depends(get_current_user)):
+    try:
+        inbox_ids = [ObjectId(inbox_id) for inbox_id in inbox_read.inbox_ids]
+    except Exception:
+        raise HTTPException(status_code=400, detail='잘못된 인박스 id 입니다.')
+
+    updated = await inbox_sync.mark_read(current_user['phone'], inbox_ids)
+    return {'message': 'success', 'updated': updated}
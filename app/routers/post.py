@@ -5,12 +5,18 @@ from bson import ObjectId
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel, Field
 
+from app import cache, counters, inbox_sync, like_buffer, ratelimit, trending
 from app.database import mongo
 from app.dependencies import get_current_user
+from app.encoding import BSONRoute
+from app.pagination import page_params, paginate, find_page
+from app.streaming import STREAM_BATCH_SIZE, stream_mode, ndjson_response
+from app.timeline import fan_out_post, remove_post, read_timeline, iter_timeline_pages
 
 router = APIRouter(
     prefix='/post',
     tags=['post'],
+    route_class=BSONRoute,
 )
 
 
@@ -24,109 +30,193 @@ class PostNew(BaseModel):
 
 
 @router.post('/')
-def new_post(post_new: PostNew, current_user: dict = Depends(get_current_user)):
+async def new_post(post_new: PostNew, current_user: dict = Depends(get_current_user)):
     data = post_new.model_dump()
 
-    for tagged_user_id in data['tagged_user_ids']:
-        tagged_user = mongo.users.find_one({'_id': ObjectId(tagged_user_id)})
-        if tagged_user is None:
+    tagged_user_ids = list(dict.fromkeys(data['tagged_user_ids']))
+    tagged_users = mongo.users.find({'_id': {'$in': [ObjectId(user_id) for user_id in tagged_user_ids]},
+                                     'deleted_at': {'$exists': False}}, {'phone': 1})
+    phones = {str(user['_id']): user['phone'] async for user in tagged_users}
+    for tagged_user_id in tagged_user_ids:
+        if tagged_user_id not in phones:
             raise HTTPException(status_code=404, detail=f'{tagged_user_id} is not found')
-        inbox_new = {
-            'phone': tagged_user['phone'],
-            'picture': data['picture_url'],
-            'location': data['location_name'],
-        }
-        mongo.inbox.insert_one(inbox_new)
 
     data['user_id'] = ObjectId(current_user['_id'])
     data['created_at'] = datetime.now()
-    res = mongo.posts.insert_one(data)
+    data['like_count'] = 0
+    data['comment_count'] = 0
+    res = await mongo.posts.insert_one(data)
+
+    if phones:
+        inbox_new = [{
+            'phone': phones[tagged_user_id],
+            'picture': data['picture_url'],
+            'location': data['location_name'],
+        } for tagged_user_id in tagged_user_ids]
+        try:
+            # 저장된 인박스는 insert_entries 가 되돌리므로 게시물만 지운다
+            await inbox_sync.insert_entries(inbox_new, atomic=True)
+        except Exception:
+            # 인박스 저장에 실패하면 게시물도 남기지 않는다
+            await mongo.posts.delete_one({'_id': res.inserted_id})
+            raise
+
+    await fan_out_post(data)
+    await trending.record(data, 'post')
     return {'message': 'success', 'post_id': str(res.inserted_id)}
 
 
+class AuthorOut(BaseModel):
+    id: str = Field(alias='_id')
+    name: Optional[str] = None
+    handle: Optional[str] = None
+    picture: Optional[str] = None
+
+
+class PostOut(BaseModel):
+    id: str = Field(alias='_id')
+    user_id: str
+    picture_url: str
+    tagged_user_ids: list[str]
+    location_name: str
+    content: Optional[str] = None
+    created_at: datetime
+    like_count: int = 0
+    comment_count: int = 0
+
+
+class PostCardOut(PostOut):
+    # 피드 카드에만 작성자가 붙는다
+    author: Optional[AuthorOut] = None
+
+
+class PostPage(BaseModel):
+    posts: list[PostCardOut]
+    next_cursor: Optional[str] = None
+
+
 class PostUpdate(BaseModel):
     content: Optional[str] = None
 
 
 @router.put('/{post_id}')
-def update_post(post_id: str, post_update: PostUpdate, current_user: dict = Depends(get_current_user)):
-    post = mongo.posts.find_one({'_id': ObjectId(post_id)})
-    if post['user_id'] != current_user['_id']:
+async def update_post(post_id: str, post_update: PostUpdate, current_user: dict = Depends(get_current_user)):
+    post = await cache.get_post(post_id)
+    if post is None:
+        raise HTTPException(status_code=404, detail='존재하지 않는 게시물입니다.')
+    if str(post['user_id']) != current_user['_id']:
         raise HTTPException(status_code=403, detail='권한이 없습니다.')
-    mongo.posts.update_one({'_id': ObjectId(post_id)}, {'$set': post_update.dict(exclude_unset=True)})
+    await mongo.posts.update_one({'_id': ObjectId(post_id)}, {'$set': post_update.dict(exclude_unset=True)})
+    await cache.invalidate_post(post_id)
     return {'message': 'success'}
 
 
 @router.delete('/{post_id}')
-def delete_post(post_id: str, current_user: dict = Depends(get_current_user)):
-    post = mongo.posts.find_one({'_id': ObjectId(post_id)})
-    if post['user_id'] != current_user['_id']:
+async def delete_post(post_id: str, current_user: dict = Depends(get_current_user)):
+    post = await cache.get_post(post_id)
+    if post is None:
+        raise HTTPException(status_code=404, detail='존재하지 않는 게시물입니다.')
+    if str(post['user_id']) != current_user['_id']:
         raise HTTPException(status_code=403, detail='권한이 없습니다.')
-    mongo.posts.delete_one({'_id': ObjectId(post_id)})
+    await mongo.posts.delete_one({'_id': ObjectId(post_id)})
+    await cache.invalidate_post(post_id)
+    await remove_post(post)
+    await counters.discard(post_id)
+    await trending.remove_post(post_id)
     return {'message': 'success'}
 
 
-@router.get('/{post_id}')
-def get_post(post_id: str, current_user: dict = Depends(get_current_user)):
-    post = mongo.posts.find_one({'_id': ObjectId(post_id)})
+@router.get('/{post_id}', response_model=PostOut)
+async def get_post(post_id: str, current_user: dict = Depends(get_current_user)):
+    post = await cache.get_post(post_id)
     if post is None:
         raise HTTPException(status_code=404, detail='존재하지 않는 게시물입니다.')
-    post['_id'] = str(post['_id'])
-    post['user_id'] = str(post['user_id'])
+    await counters.attach([post])
     return post
 
 
-@router.get('/')
-def get_posts(current_user: dict = Depends(get_current_user)):
-    followings = mongo.follows.find({'from_user_id': current_user['_id'], 'status': 'accepted'})
-    followings = [str(following['to_user_id']) for following in followings]
-    followings.append(str(current_user['_id']))
-    print(followings)
-    posts = mongo.posts.find({'user_id': {'$in': [ObjectId(following) for following in followings]}})
-    posts = [post for post in posts]
-    for post in posts:
-        post['_id'] = str(post['_id'])
-        post['user_id'] = str(post['user_id'])
-    return {'posts': posts}
+async def _stream_feed(user_id, cursor):
+    async for posts in iter_timeline_pages(user_id, STREAM_BATCH_SIZE, cursor):
+        for post in await counters.attach(posts):
+            yield post
+
+
+@router.get('/', response_model=PostPage)
+async def get_posts(page: dict = Depends(page_params), stream: bool = Depends(stream_mode),
+                    current_user: dict = Depends(get_current_user)):
+    if stream:
+        return ndjson_response(_stream_feed(current_user['_id'], page['cursor']))
+
+    posts, next_cursor = await read_timeline(current_user['_id'], **page)
+    await counters.attach(posts)
+    return {'posts': posts, 'next_cursor': next_cursor}
 
 
-@router.post('/{post_id}/like')
-def like_post(post_id: str, current_user: dict = Depends(get_current_user)):
-    post = mongo.posts.find_one({'_id': ObjectId(post_id)})
+# 좋아요와 취소는 같은 버킷을 써서 좋아요/취소를 반복해도 제한에 걸리게 한다
+LIKE_RATE_LIMIT = ratelimit.rate_limit('like', 60, 60, key=ratelimit.USER)
+
+
+@router.post('/{post_id}/like', dependencies=[LIKE_RATE_LIMIT])
+async def like_post(post_id: str, current_user: dict = Depends(get_current_user)):
+    post = await cache.get_post(post_id)
     if post is None:
         raise HTTPException(status_code=404, detail='존재하지 않는 게시물입니다.')
-    mongo.likes.update_one({'user_id': current_user['_id'], 'post_id': ObjectId(post_id)},
-                           {'$set': {'user_id': current_user['_id'], 'post_id': ObjectId(post_id)}},
-                           upsert=True)
+    # Mongo 에는 like_buffer 의 flusher 가 모아서 반영한다
+    if await like_buffer.set_state(current_user['_id'], post_id, True):
+        await counters.incr(post, 'like_count')
+        await trending.record(post, 'like')
     return {'message': 'success'}
 
 
-@router.delete('/{post_id}/like')
-def unlike_post(post_id: str, current_user: dict = Depends(get_current_user)):
-    post = mongo.posts.find_one({'_id': ObjectId(post_id)})
+@router.delete('/{post_id}/like', dependencies=[LIKE_RATE_LIMIT])
+async def unlike_post(post_id: str, current_user: dict = Depends(get_current_user)):
+    post = await cache.get_post(post_id)
     if post is None:
         raise HTTPException(status_code=404, detail='존재하지 않는 게시물입니다.')
-    mongo.likes.delete_one({'user_id': current_user['_id'], 'post_id': ObjectId(post_id)})
+    if await like_buffer.set_state(current_user['_id'], post_id, False):
+        await counters.incr(post, 'like_count', -1)
     return {'message': 'success'}
 
 
 @router.get('/{post_id}/like')
-def get_likes(post_id: str, current_user: dict = Depends(get_current_user)):
-    post = mongo.posts.find_one({'_id': ObjectId(post_id)})
+async def get_likes(post_id: str, page: dict = Depends(page_params),
+                    current_user: dict = Depends(get_current_user)):
+    post = await cache.get_post(post_id)
     if post is None:
         raise HTTPException(status_code=404, detail='존재하지 않는 게시물입니다.')
-    likes = mongo.likes.find({'post_id': ObjectId(post_id)})
-    likes = [str(like['user_id']) for like in likes]
-    return {'likes': likes}
+    likes, next_cursor = await paginate(mongo.likes, {'post_id': ObjectId(post_id)},
+                                        projection={'user_id': 1}, **page)
+    likes = [like['user_id'] for like in likes]
+
+    # 아직 flush 되지 않은 본인의 좋아요/취소를 반영한다
+    state = await like_buffer.buffered_state(current_user['_id'], post_id)
+    if state == like_buffer.UNLIKED:
+        likes = [user_id for user_id in likes if user_id != current_user['_id']]
+    elif state == like_buffer.LIKED and not page['cursor'] and current_user['_id'] not in likes:
+        likes.insert(0, current_user['_id'])
+    return {'likes': likes, 'next_cursor': next_cursor}
 
 
 class CommentCreate(BaseModel):
     content: str = Field(min_length=1, max_length=200)
 
 
-@router.post('/{post_id}/comment')
-def comment_post(post_id: str, comment_new: CommentCreate, current_user: dict = Depends(get_current_user)):
-    post = mongo.posts.find_one({'_id': ObjectId(post_id)})
+class CommentOut(BaseModel):
+    id: str = Field(alias='_id')
+    user_id: str
+    post_id: str
+    content: str
+    created_at: datetime
+
+
+class CommentPage(BaseModel):
+    comments: list[CommentOut]
+    next_cursor: Optional[str] = None
+
+
+@router.post('/{post_id}/comment', dependencies=[ratelimit.rate_limit('comment', 30, 60, key=ratelimit.USER)])
+async def comment_post(post_id: str, comment_new: CommentCreate, current_user: dict = Depends(get_current_user)):
+    post = await cache.get_post(post_id)
     if post is None:
         raise HTTPException(status_code=404, detail='존재하지 않는 게시물입니다.')
     comment = comment_new.model_dump()
@@ -135,60 +225,65 @@ def comment_post(post_id: str, comment_new: CommentCreate, current_user: dict =
         'post_id': ObjectId(post_id),
         'created_at': datetime.now(),
     })
-    mongo.comments.insert_one(comment)
+    await mongo.comments.insert_one(comment)
+    await counters.incr(post, 'comment_count')
+    await trending.record(post, 'comment')
     return {'message': 'success'}
 
 
-@router.get('/{post_id}/comment')
-def get_comments(post_id: str, current_user: dict = Depends(get_current_user)):
-    post = mongo.posts.find_one({'_id': ObjectId(post_id)})
+@router.get('/{post_id}/comment', response_model=CommentPage)
+async def get_comments(post_id: str, page: dict = Depends(page_params), stream: bool = Depends(stream_mode),
+                       current_user: dict = Depends(get_current_user)):
+    post = await cache.get_post(post_id)
     if post is None:
         raise HTTPException(status_code=404, detail='존재하지 않는 게시물입니다.')
-    comments = mongo.comments.find({'post_id': ObjectId(post_id)})
-    comments = [comment for comment in comments]
-    for comment in comments:
-        comment['_id'] = str(comment['_id'])
-        comment['user_id'] = str(comment['user_id'])
-    return {'comments': comments}
+    if stream:
+        comments = find_page(mongo.comments, {'post_id': ObjectId(post_id)}, page['cursor'],
+                             sort_key='created_at', descending=False)
+        return ndjson_response(comments.batch_size(STREAM_BATCH_SIZE))
+
+    comments, next_cursor = await paginate(mongo.comments, {'post_id': ObjectId(post_id)},
+                                           sort_key='created_at', descending=False, **page)
+    return {'comments': comments, 'next_cursor': next_cursor}
 
 
 @router.delete('/{post_id}/comment/{comment_id}')
-def delete_comment(post_id: str, comment_id: str, current_user: dict = Depends(get_current_user)):
-    post = mongo.posts.find_one({'_id': ObjectId(post_id)})
+async def delete_comment(post_id: str, comment_id: str, current_user: dict = Depends(get_current_user)):
+    post = await cache.get_post(post_id)
     if post is None:
         raise HTTPException(status_code=404, detail='존재하지 않는 게시물입니다.')
-    comment = mongo.comments.find_one({'_id': ObjectId(comment_id)})
+    comment = await mongo.comments.find_one({'_id': ObjectId(comment_id)})
     if comment is None:
         raise HTTPException(status_code=404, detail='존재하지 않는 댓글입니다.')
     if comment['user_id'] != current_user['_id']:
         raise HTTPException(status_code=403, detail='권한이 없습니다.')
-    mongo.comments.delete_one({'_id': ObjectId(comment_id)})
+    res = await mongo.comments.delete_one({'_id': ObjectId(comment_id)})
+    if res.deleted_count:
+        await counters.incr(post, 'comment_count', -1)
     return {'message': 'success'}
 
 
-@router.get('/{post_id}/comment/{comment_id}')
-def get_comment(post_id: str, comment_id: str, current_user: dict = Depends(get_current_user)):
-    post = mongo.posts.find_one({'_id': ObjectId(post_id)})
+@router.get('/{post_id}/comment/{comment_id}', response_model=CommentOut)
+async def get_comment(post_id: str, comment_id: str, current_user: dict = Depends(get_current_user)):
+    post = await cache.get_post(post_id)
     if post is None:
         raise HTTPException(status_code=404, detail='존재하지 않는 게시물입니다.')
-    comment = mongo.comments.find_one({'_id': ObjectId(comment_id)})
+    comment = await mongo.comments.find_one({'_id': ObjectId(comment_id)})
     if comment is None:
         raise HTTPException(status_code=404, detail='존재하지 않는 댓글입니다.')
-    comment['_id'] = str(comment['_id'])
-    comment['user_id'] = str(comment['user_id'])
     return comment
 
 
 @router.put('/{post_id}/comment/{comment_id}')
-def update_comment(post_id: str, comment_id: str, comment_update: CommentCreate,
-                   current_user: dict = Depends(get_current_user)):
-    post = mongo.posts.find_one({'_id': ObjectId(post_id)})
+async def update_comment(post_id: str, comment_id: str, comment_update: CommentCreate,
+                         current_user: dict = Depends(get_current_user)):
+    post = await cache.get_post(post_id)
     if post is None:
         raise HTTPException(status_code=404, detail='존재하지 않는 게시물입니다.')
-    comment = mongo.comments.find_one({'_id': ObjectId(comment_id)})
+    comment = await mongo.comments.find_one({'_id': ObjectId(comment_id)})
     if comment is None:
         raise HTTPException(status_code=404, detail='존재하지 않는 댓글입니다.')
     if comment['user_id'] != current_user['_id']:
         raise HTTPException(status_code=403, detail='권한이 없습니다.')
-    mongo.comments.update_one({'_id': ObjectId(comment_id)}, {'$set': comment_update.dict(exclude_unset=True)})
+    await mongo.comments.update_one({'_id': ObjectId(comment_id)}, {'$set': comment_update.dict(exclude_unset=True)})
     return {'message': 'success'}
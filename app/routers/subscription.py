@@ -1,93 +1,139 @@
 import stripe
 from bson import ObjectId
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import RedirectResponse
+from starlette.concurrency import run_in_threadpool
 
+from app import cache, metrics
+from app.config import config
 from app.database import mongo
 from app.dependencies import get_current_user
+from app.encoding import BSONRoute
 
 router = APIRouter(
     prefix='/subscription',
     tags=['subscription'],
+    route_class=BSONRoute,
 )
 
+# 같은 초에 생성된 이벤트는 뒤 단계의 이벤트를 우선한다
+SUBSCRIPTION_EVENTS = {
+    'customer.subscription.created': 0,
+    'customer.subscription.updated': 1,
+    'customer.subscription.deleted': 2,
+}
+
+
+async def set_subscription(user_id: str, fields: dict):
+    await mongo.users.update_one({'_id': ObjectId(user_id)}, {'$set': fields})
+    await cache.invalidate_user(user_id)
+
+
+async def apply_subscription_event(user_id: str, event_at: int, rank: int, fields: dict):
+    # Stripe 는 이벤트 순서를 보장하지 않으므로 저장된 이벤트보다 새로운 경우에만 반영한다
+    await mongo.users.update_one({
+        '_id': ObjectId(user_id),
+        '$or': [
+            {'subscription_event_at': {'$exists': False}},
+            {'subscription_event_at': {'$lt': event_at}},
+            {'subscription_event_at': event_at, 'subscription_event_rank': {'$lt': rank}},
+        ],
+    }, {'$set': {**fields, 'subscription_event_at': event_at, 'subscription_event_rank': rank}})
+    await cache.invalidate_user(user_id)
+
 
 @router.post('/')
-def new_subscription(current_user: dict = Depends(get_current_user)):
-    try:
-        stripe.Customer.retrieve(current_user['_id'])
-    except Exception:
-        stripe.Customer.create(
-            id=current_user['_id'],
-            name=current_user['name'],
+async def new_subscription(current_user: dict = Depends(get_current_user)):
+    user = await cache.get_user(current_user['_id'])
+    if not user:
+        raise HTTPException(status_code=404, detail='존재하지 않는 유저입니다.')
+
+    # 고객 id 를 users 에 저장해 두고 Customer.retrieve 확인 호출을 생략한다
+    if not user.get('stripe_customer_id'):
+        try:
+            with metrics.timed('stripe', 'customer.create'):
+                await run_in_threadpool(
+                    stripe.Customer.create,
+                    id=current_user['_id'],
+                    name=user['name'],
+                )
+        except stripe.error.InvalidRequestError as e:
+            if e.code != 'resource_already_exists':
+                raise
+        await set_subscription(current_user['_id'], {'stripe_customer_id': current_user['_id']})
+
+    with metrics.timed('stripe', 'checkout.session.create'):
+        res = await run_in_threadpool(
+            stripe.checkout.Session.create,
+            customer=current_user['_id'],
+            payment_method_types=['card'],
+            line_items=[{
+                'price': 'price_1OdGkMKfQ8fGhO9ZsAVymvvd',
+                'quantity': 1,
+            }],
+            mode='subscription',
+            success_url=f'https://apiv2.mycut4cut.click/subscription/callback?user_id={current_user["_id"]}',
+            cancel_url=f'https://apiv2.mycut4cut.click/subscription/cancel?user_id={current_user["_id"]}',
         )
 
-    res = stripe.checkout.Session.create(
-        customer=current_user['_id'],
-        payment_method_types=['card'],
-        line_items=[{
-            'price': 'price_1OdGkMKfQ8fGhO9ZsAVymvvd',
-            'quantity': 1,
-        }],
-        mode='subscription',
-        success_url=f'https://apiv2.mycut4cut.click/subscription/callback?user_id={current_user["_id"]}',
-        cancel_url=f'https://apiv2.mycut4cut.click/subscription/cancel?user_id={current_user["_id"]}',
-    )
-
     return {'url': res['url']}
 
 
-@router.get('/callback/success')
-def callback_subscription(user_id: str):
-    subscription_id = stripe.Subscription.list(customer=user_id)['data'][0]['id']
-    mongo.users.update_one({'_id': ObjectId(user_id)}, {'$set': {
-        'subscription_id': subscription_id,
-    }})
-
-    subscription_status = stripe.Subscription.retrieve(subscription_id)['status']
-    if subscription_status == 'active':
-        mongo.users.update_one({'_id': ObjectId(user_id)}, {'$set': {
-            'subscription_status': 'active',
-        }})
-    else:
-        mongo.users.update_one({'_id': ObjectId(user_id)}, {'$set': {
-            'subscription_status': 'inactive',
-        }})
+@router.post('/webhook')
+async def subscription_webhook(request: Request):
+    secret = config.get('STRIPE_WEBHOOK_SECRET')
+    if not secret:
+        raise HTTPException(status_code=400, detail='Invalid signature')
 
+    payload = await request.body()
+    try:
+        event = stripe.Webhook.construct_event(payload, request.headers.get('stripe-signature'), secret)
+    except (ValueError, stripe.error.SignatureVerificationError):
+        raise HTTPException(status_code=400, detail='Invalid signature')
+
+    data = event['data']['object']
+    if event['type'] == 'checkout.session.completed' and data.get('subscription'):
+        await set_subscription(data['customer'], {'subscription_id': data['subscription']})
+    elif event['type'] in SUBSCRIPTION_EVENTS:
+        active = event['type'] != 'customer.subscription.deleted' and data['status'] == 'active'
+        await apply_subscription_event(data['customer'], event['created'], SUBSCRIPTION_EVENTS[event['type']], {
+            'subscription_id': data['id'],
+            'subscription_status': 'active' if active else 'inactive',
+        })
+
+    return {'message': 'success'}
+
+
+@router.get('/callback/success')
+async def callback_subscription(user_id: str):
+    # 구독 상태는 webhook 으로 갱신된다
     return RedirectResponse(url=f'https://mycut4cut.com/subs_callback/success?user_id={user_id}')
 
 
 @router.get('/callback/cancel')
-def callback_subscription(user_id: str):
-    mongo.users.update_one({'_id': ObjectId(user_id)}, {'$set': {
-        'subscription_status': 'inactive',
-    }})
-
+async def callback_subscription(user_id: str):
+    # 결제를 중단해도 기존 구독은 유지되므로 상태는 webhook 으로만 갱신한다
     return RedirectResponse(url=f'https://mycut4cut.com/subs_callback/cancel?user_id={user_id}')
 
 
 @router.post('/cancel')
-def subscription_cancel(current_user=Depends(get_current_user)):
-    stripe.Subscription.delete(
-        stripe.Subscription.list(customer=current_user['_id'])['data'][0]['id'],
-    )
+async def subscription_cancel(current_user=Depends(get_current_user)):
+    user = await cache.get_user(current_user['_id'])
+    subscription_id = user.get('subscription_id') if user else None
+    if not subscription_id:
+        with metrics.timed('stripe', 'subscription.list'):
+            subscriptions = await run_in_threadpool(stripe.Subscription.list, customer=current_user['_id'])
+        subscription_id = subscriptions['data'][0]['id']
+    with metrics.timed('stripe', 'subscription.delete'):
+        await run_in_threadpool(stripe.Subscription.delete, subscription_id)
 
     return {'message': 'success'}
 
 
 @router.get('/status/{user_id}')
-def subscription_status(user_id: str):
-    subscription_status = stripe.Subscription.retrieve(
-        stripe.Subscription.list(customer=user_id)['data'][0]['id']
-    )['status']
-
-    if subscription_status == 'active':
-        mongo.users.update_one({'_id': ObjectId(user_id)}, {'$set': {
-            'subscription_status': 'active',
-        }})
-    else:
-        mongo.users.update_one({'_id': ObjectId(user_id)}, {'$set': {
-            'subscription_status': 'inactive',
-        }})
-
-    return {'message': 'success', 'subscription_status': subscription_status}
+async def subscription_status(user_id: str):
+    user = await cache.get_user(user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail='존재하지 않는 유저입니다.')
+
+    return {'message': 'success', 'subscription_status': user.get('subscription_status', 'inactive')}
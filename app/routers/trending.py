@@ -0,0 +1,41 @@
+from bson import ObjectId
+from fastapi import APIRouter, Depends, Query
+
+from app import counters, trending
+from app.database import mongo
+from app.dependencies import get_current_user
+from app.encoding import BSONRoute
+from app.feed import get_cards
+from app.pagination import DEFAULT_LIMIT, MAX_LIMIT
+
+router = APIRouter(
+    prefix='/trending',
+    tags=['trending'],
+    route_class=BSONRoute,
+)
+
+
+@router.get('/posts')
+async def get_trending_posts(limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+                             current_user: dict = Depends(get_current_user)):
+    ranked = await trending.top(trending.TRENDING_POSTS_KEY, limit)
+    cards = await get_cards([ObjectId(post_id) for post_id, _ in ranked])
+    # 비공개 계정의 게시물은 순위에서 제외한다
+    private = mongo.users.find({'_id': {'$in': list({post['user_id'] for post in cards.values()})},
+                                'is_public': False}, {'_id': 1})
+    private = {user['_id'] async for user in private}
+
+    posts = []
+    for post_id, score in ranked:
+        post = cards.get(ObjectId(post_id))
+        if post is not None and post['user_id'] not in private:
+            posts.append({**post, 'score': round(score, 3)})
+    await counters.attach(posts)
+    return {'posts': posts}
+
+
+@router.get('/locations')
+async def get_top_locations(limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+                            current_user: dict = Depends(get_current_user)):
+    ranked = await trending.top(trending.TOP_LOCATIONS_KEY, limit)
+    return {'locations': [{'location_name': name, 'score': round(score, 3)} for name, score in ranked]}
@@ -2,20 +2,31 @@ from typing import Optional
 
 from bson import ObjectId
 from fastapi import APIRouter, Depends, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
+from app import cache, contacts, counters, deletion, graph, ratelimit
 from app.database import mongo
-from app.dependencies import get_current_user
+from app.dependencies import get_current_user, revoke_tokens
+from app.encoding import BSONRoute
+from app.feed import AUTHOR_LOOKUP
+from app.pagination import page_params, paginate
+from app.routers.post import PostPage
+from app.timeline import add_author, remove_author
 
 router = APIRouter(
     prefix='/user',
     tags=['user'],
+    route_class=BSONRoute,
 )
 
 
 @router.get('/me')
-def get_me(current_user: dict = Depends(get_current_user)):
-    return current_user
+async def get_me(current_user: dict = Depends(get_current_user)):
+    user = await cache.get_user(current_user['_id'])
+    if not user:
+        raise HTTPException(status_code=404, detail='존재하지 않는 유저입니다.')
+
+    return user
 
 
 class UserUpdate(BaseModel):
@@ -27,136 +38,172 @@ class UserUpdate(BaseModel):
 
 
 @router.put('/me')
-def update_me(user_update: UserUpdate, current_user: dict = Depends(get_current_user)):
-    mongo.users.update_one({'_id': current_user['_id']}, {'$set': user_update.dict(exclude_unset=True)})
+async def update_me(user_update: UserUpdate, current_user: dict = Depends(get_current_user)):
+    await mongo.users.update_one({'_id': ObjectId(current_user['_id'])},
+                                 {'$set': user_update.dict(exclude_unset=True)})
+    await cache.invalidate_user(current_user['_id'])
     return {'message': 'success'}
 
 
 @router.delete('/me')
-def delete_me(current_user: dict = Depends(get_current_user)):
-    mongo.users.delete_one({'_id': current_user['_id']})
+async def delete_me(current_user: dict = Depends(get_current_user)):
+    # 게시물, 좋아요, 댓글, 팔로우, 인박스는 백그라운드 작업이 나눠서 지운다
+    await deletion.tombstone(current_user['_id'])
+    await revoke_tokens(current_user['_id'])
     return {'message': 'success'}
 
 
-@router.get('/me/posts')
-def get_me_posts(current_user: dict = Depends(get_current_user)):
-    posts = mongo.posts.find({'user_id': ObjectId(current_user['_id'])})
-    for post in posts:
-        post['_id'] = str(post['_id'])
-        post['user_id'] = str(post['user_id'])
-    return {'posts': posts}
+CONTACTS_MAX = 5000
+
+
+class ContactSync(BaseModel):
+    # 전화번호('01012345678')의 sha256 hex
+    phone_hashes: list[str] = Field(max_length=CONTACTS_MAX)
+
+
+@router.post('/contacts', dependencies=[ratelimit.rate_limit('contacts', 10, 60 * 60, key=ratelimit.USER)])
+async def sync_contacts(contact_sync: ContactSync, current_user: dict = Depends(get_current_user)):
+    users = await contacts.resolve([phone_hash.lower() for phone_hash in contact_sync.phone_hashes],
+                                   ObjectId(current_user['_id']))
+    return {'users': users}
+
+
+@router.get('/me/posts', response_model=PostPage)
+async def get_me_posts(page: dict = Depends(page_params), current_user: dict = Depends(get_current_user)):
+    posts, next_cursor = await paginate(mongo.posts, {'user_id': ObjectId(current_user['_id'])},
+                                        sort_key='created_at', lookup=AUTHOR_LOOKUP, **page)
+    await counters.attach(posts)
+    return {'posts': posts, 'next_cursor': next_cursor}
 
 
 @router.get('/me/followers')
-def get_me_followers(current_user: dict = Depends(get_current_user)):
-    followers = mongo.follows.find({'to_user_id': ObjectId(current_user['_id'])})
-    followers = [str(follower['from_user_id']) for follower in followers]
-    return {'followers': followers}
+async def get_me_followers(page: dict = Depends(page_params), current_user: dict = Depends(get_current_user)):
+    followers, next_cursor = await paginate(mongo.follows, {'to_user_id': ObjectId(current_user['_id'])},
+                                             projection={'from_user_id': 1}, **page)
+    followers = [follower['from_user_id'] for follower in followers]
+    return {'followers': followers, 'next_cursor': next_cursor}
 
 
 @router.post('/me/followers/{user_id}/accept')
-def accept_follower(user_id: str, current_user: dict = Depends(get_current_user)):
-    mongo.follows.update_one({'from_user_id': ObjectId(user_id), 'to_user_id': ObjectId(current_user['_id'])},
-                             {'$set': {'status': 'accepted'}})
+async def accept_follower(user_id: str, current_user: dict = Depends(get_current_user)):
+    if await graph.accept(user_id, current_user['_id']):
+        await add_author(user_id, current_user['_id'])
     return {'message': 'success'}
 
 
 @router.get('/me/followings')
-def get_me_followings(current_user: dict = Depends(get_current_user)):
-    followings = mongo.follows.find({'from_user_id': ObjectId(current_user['_id'])})
-    followings = [str(following['to_user_id']) for following in followings]
-    return {'followings': followings}
+async def get_me_followings(page: dict = Depends(page_params), current_user: dict = Depends(get_current_user)):
+    followings, next_cursor = await paginate(mongo.follows, {'from_user_id': ObjectId(current_user['_id'])},
+                                              projection={'to_user_id': 1}, **page)
+    followings = [following['to_user_id'] for following in followings]
+    return {'followings': followings, 'next_cursor': next_cursor}
+
+
+@router.get('/me/mutuals')
+async def get_me_mutuals(current_user: dict = Depends(get_current_user)):
+    return {'mutuals': list(await graph.mutuals(current_user['_id']))}
 
 
 @router.delete('/me/followings/{user_id}')
-def delete_following(user_id: str, current_user: dict = Depends(get_current_user)):
-    mongo.follows.delete_one({'from_user_id': ObjectId(current_user['_id']), 'to_user_id': ObjectId(user_id)})
+async def delete_following(user_id: str, current_user: dict = Depends(get_current_user)):
+    await graph.unfollow(current_user['_id'], user_id)
+    await remove_author(current_user['_id'], user_id)
     return {'message': 'success'}
 
 
 @router.get('/{user_id}')
-def get_user(user_id: str, current_user: dict = Depends(get_current_user)):
-    user = mongo.users.find_one({'_id': ObjectId(user_id)})
+async def get_user(user_id: str, current_user: dict = Depends(get_current_user)):
+    user = await cache.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail='존재하지 않는 유저입니다.')
 
-    user['_id'] = str(user['_id'])
     return user
 
 
-@router.get('/{user_id}/posts')
-def get_user_posts(user_id: str, current_user: dict = Depends(get_current_user)):
-    user = mongo.users.find_one({'_id': ObjectId(user_id)})
+@router.get('/{user_id}/posts', response_model=PostPage)
+async def get_user_posts(user_id: str, page: dict = Depends(page_params),
+                         current_user: dict = Depends(get_current_user)):
+    user = await cache.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail='존재하지 않는 유저입니다.')
     # if user['is_public'] is False and user_id != current_user['_id']:
     #     raise HTTPException(status_code=403, detail='비공개 계정입니다.')
     # -> 비공개 계정이어도 팔로우한 유저의 게시물은 볼 수 있도록 수정
-    followings = mongo.follows.find({'from_user_id': ObjectId(current_user['_id']), 'status': 'accepted'})
-    followings = [str(following['to_user_id']) for following in followings]
-    followings.append(str(current_user['_id']))
-    if user_id not in followings:
+    if user_id != current_user['_id'] and not await graph.is_following(current_user['_id'], user_id):
         raise HTTPException(status_code=403, detail='비공개 계정입니다.')
 
-    posts = mongo.posts.find({'user_id': user_id})
-    for post in posts:
-        post['_id'] = str(post['_id'])
-        post['user_id'] = str(post['user_id'])
-    return {'posts': posts}
+    posts, next_cursor = await paginate(mongo.posts, {'user_id': ObjectId(user_id)}, sort_key='created_at',
+                                        lookup=AUTHOR_LOOKUP, **page)
+    await counters.attach(posts)
+    return {'posts': posts, 'next_cursor': next_cursor}
 
 
 @router.post('/{user_id}/follow')
-def follow_user(user_id: str, current_user: dict = Depends(get_current_user)):
-    user = mongo.users.find_one({'_id': ObjectId(user_id)})
+async def follow_user(user_id: str, current_user: dict = Depends(get_current_user)):
+    user = await cache.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail='존재하지 않는 유저입니다.')
     if user_id == current_user['_id']:
         raise HTTPException(status_code=403, detail='자기 자신을 팔로우할 수 없습니다.')
-    if mongo.follows.find_one({'from_user_id': ObjectId(current_user['_id']), 'to_user_id': ObjectId(user_id)}):
+    if await graph.relation(current_user['_id'], user_id):
         raise HTTPException(status_code=403, detail='이미 팔로우한 유저입니다.')
-    if user['is_public'] is False:
-        mongo.follows.insert_one({'from_user_id': ObjectId(current_user['_id']), 'to_user_id': ObjectId(user_id)},
-                                 status="pending")
+    if user.get('is_public') is False:
+        await graph.follow(current_user['_id'], user_id, graph.PENDING)
     else:
-        mongo.follows.insert_one({'from_user_id': ObjectId(current_user['_id']), 'to_user_id': ObjectId(user_id)},
-                                 status="accepted")
+        await graph.follow(current_user['_id'], user_id, graph.ACCEPTED)
+        await add_author(current_user['_id'], user_id)
     return {'message': 'success'}
 
 
 @router.delete('/{user_id}/follow')
-def unfollow_user(user_id: str, current_user: dict = Depends(get_current_user)):
-    user = mongo.users.find_one({'_id': ObjectId(user_id)})
+async def unfollow_user(user_id: str, current_user: dict = Depends(get_current_user)):
+    user = await cache.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail='존재하지 않는 유저입니다.')
     if user_id == current_user['_id']:
         raise HTTPException(status_code=403, detail='자기 자신을 팔로우할 수 없습니다.')
-    if not mongo.follows.find_one({'from_user_id': ObjectId(current_user['_id']), 'to_user_id': ObjectId(user_id)}):
+    if not await graph.unfollow(current_user['_id'], user_id):
         raise HTTPException(status_code=403, detail='팔로우하지 않은 유저입니다.')
-    mongo.follows.delete_one({'from_user_id': ObjectId(current_user['_id']), 'to_user_id': ObjectId(user_id)})
+    await remove_author(current_user['_id'], user_id)
     return {'message': 'success'}
 
 
 @router.get('/{user_id}/followers')
-def get_user_followers(user_id: str, current_user: dict = Depends(get_current_user)):
-    user = mongo.users.find_one({'_id': ObjectId(user_id)})
+async def get_user_followers(user_id: str, page: dict = Depends(page_params),
+                             current_user: dict = Depends(get_current_user)):
+    user = await cache.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail='존재하지 않는 유저입니다.')
-    if user['is_public'] is False and user_id != current_user['_id']:
+    if user.get('is_public') is False and user_id != current_user['_id']:
         raise HTTPException(status_code=403, detail='비공개 계정입니다.')
 
-    followers = mongo.follows.find({'to_user_id': ObjectId(user_id)})
-    followers = [str(follower['from_user_id']) for follower in followers]
-    return {'followers': followers}
+    followers, next_cursor = await paginate(mongo.follows, {'to_user_id': ObjectId(user_id)},
+                                             projection={'from_user_id': 1}, **page)
+    followers = [follower['from_user_id'] for follower in followers]
+    return {'followers': followers, 'next_cursor': next_cursor}
 
 
 @router.get('/{user_id}/followings')
-def get_user_followings(user_id: str, current_user: dict = Depends(get_current_user)):
-    user = mongo.users.find_one({'_id': ObjectId(user_id)})
+async def get_user_followings(user_id: str, page: dict = Depends(page_params),
+                              current_user: dict = Depends(get_current_user)):
+    user = await cache.get_user(user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail='존재하지 않는 유저입니다.')
+    if user.get('is_public') is False and user_id != current_user['_id']:
+        raise HTTPException(status_code=403, detail='비공개 계정입니다.')
+
+    followings, next_cursor = await paginate(mongo.follows, {'from_user_id': ObjectId(user_id)},
+                                              projection={'to_user_id': 1}, **page)
+    followings = [following['to_user_id'] for following in followings]
+    return {'followings': followings, 'next_cursor': next_cursor}
+
+
+@router.get('/{user_id}/common_followings')
+async def get_common_followings(user_id: str, current_user: dict = Depends(get_current_user)):
+    user = await cache.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail='존재하지 않는 유저입니다.')
-    if user['is_public'] is False and user_id != current_user['_id']:
+    if user.get('is_public') is False and user_id != current_user['_id']:
         raise HTTPException(status_code=403, detail='비공개 계정입니다.')
 
-    followings = mongo.follows.find({'from_user_id': ObjectId(user_id)})
-    followings = [str(following['to_user_id']) for following in followings]
-    return {'followings': followings}
+    return {'followings': list(await graph.common_followings(current_user['_id'], user_id))}
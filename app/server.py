@@ -0,0 +1,36 @@
+import glob
+import os
+import tempfile
+
+import uvicorn
+
+from app.config import config
+
+
+def main():
+    workers = int(config.get('WEB_CONCURRENCY') or os.cpu_count() or 1)
+    if workers > 1 and 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        # 워커별 메트릭을 합치기 위한 디렉터리. 워커는 환경 변수를 물려받는다
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='prometheus-')
+    metrics_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir:
+        # 지정된 디렉터리에 다른 파일이 있을 수 있으므로 이전 실행의 메트릭 파일만 지운다
+        os.makedirs(metrics_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(metrics_dir, '*.db')):
+            os.remove(path)
+
+    # 워커마다 Mongo/Redis 풀을 따로 가지므로 전체 연결 수는 workers * pool size 이다
+    uvicorn.run(
+        'app.main:app',
+        host=config.get('HOST') or '0.0.0.0',
+        port=int(config.get('PORT') or 8000),
+        workers=workers,
+        proxy_headers=True,
+        forwarded_allow_ips=config.get('FORWARDED_ALLOW_IPS') or '127.0.0.1',
+        timeout_keep_alive=int(config.get('KEEP_ALIVE_TIMEOUT') or 5),
+        access_log=False,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+import socket
+
+from app import metrics
+from app.aws_client import sns_client
+from app.config import config
+from app.database import redis
+
+logger = logging.getLogger(__name__)
+
+SMS_STREAM = 'sms:outbox'
+SMS_DEAD_STREAM = 'sms:dead'
+SMS_GROUP = 'sms-workers'
+SMS_STREAM_MAXLEN = 100000
+BATCH_SIZE = 50
+BLOCK_MS = 5000
+MAX_ATTEMPTS = 3
+# 실패한 메시지를 다시 보내기까지의 대기 시간. 죽은 워커의 메시지도 같은 시간이 지나면 회수한다
+CLAIM_IDLE_MS = 30 * 1000
+
+
+class SnsSender:
+    def send(self, phone, message):
+        with metrics.timed('sns', 'publish'):
+            sns_client.publish(PhoneNumber=phone, Message=message)
+
+
+class FakeSender:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, phone, message):
+        self.sent.append((phone, message))
+
+
+SENDERS = {
+    'sns': SnsSender,
+    'fake': FakeSender,
+}
+
+
+def get_sender():
+    return SENDERS[config.get('SMS_SENDER') or 'sns']()
+
+
+async def enqueue(phone, message):
+    await redis.xadd(SMS_STREAM, {'phone': phone, 'message': message},
+                     maxlen=SMS_STREAM_MAXLEN, approximate=True)
+
+
+async def _dispatch(sender, fields):
+    try:
+        await asyncio.to_thread(sender.send, fields['phone'], fields['message'])
+        return True
+    except Exception:
+        logger.exception('SMS 발송 실패')
+        return False
+
+
+async def delivery_counts(messages):
+    pipe = redis.pipeline(transaction=False)
+    for message_id, _ in messages:
+        pipe.xpending_range(SMS_STREAM, SMS_GROUP, message_id, message_id, 1)
+    return {
+        message_id: pending[0]['times_delivered'] if pending else 1
+        for (message_id, _), pending in zip(messages, await pipe.execute())
+    }
+
+
+async def process_batch(sender, messages, deliveries=None):
+    if not messages:
+        return 0
+    deliveries = deliveries or {}
+    sent = await asyncio.gather(*[_dispatch(sender, fields) for _, fields in messages])
+
+    # 실패한 메시지는 ack 하지 않고 남겨 두어 CLAIM_IDLE_MS 뒤에 xautoclaim 으로 다시 시도한다
+    done = []
+    for (message_id, fields), ok in zip(messages, sent):
+        attempts = deliveries.get(message_id, 1)
+        if not ok and attempts >= MAX_ATTEMPTS:
+            await redis.xadd(SMS_DEAD_STREAM, {**fields, 'attempts': attempts})
+        if ok or attempts >= MAX_ATTEMPTS:
+            done.append(message_id)
+    if done:
+        await redis.xack(SMS_STREAM, SMS_GROUP, *done)
+        await redis.xdel(SMS_STREAM, *done)
+    return len(done)
+
+
+async def ensure_group():
+    try:
+        await redis.xgroup_create(SMS_STREAM, SMS_GROUP, id='0', mkstream=True)
+    except Exception as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+async def run_worker(sender=None, consumer=None):
+    sender = sender or get_sender()
+    consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+    await ensure_group()
+
+    while True:
+        # 실패했거나 죽은 워커가 처리하지 못한 메시지를 회수한다
+        _, claimed, *_ = await redis.xautoclaim(SMS_STREAM, SMS_GROUP, consumer, CLAIM_IDLE_MS,
+                                                count=BATCH_SIZE)
+        claimed = [(message_id, fields) for message_id, fields in claimed if fields]
+        if claimed:
+            await process_batch(sender, claimed, await delivery_counts(claimed))
+
+        res = await redis.xreadgroup(SMS_GROUP, consumer, {SMS_STREAM: '>'}, count=BATCH_SIZE, block=BLOCK_MS)
+        for _, messages in res or []:
+            await process_batch(sender, messages)
+
+
+if __name__ == '__main__':
+    metrics.serve(int(config.get('SMS_METRICS_PORT') or 9101))
+    asyncio.run(run_worker())
@@ -0,0 +1,82 @@
+import asyncio
+import re
+import ssl
+from base64 import b64decode
+from urllib.parse import urlparse
+
+import requests
+import rsa
+from pyasn1.codec.der import decoder
+from pyasn1.type import univ
+
+from app import metrics
+
+# SNS 가 서명에 쓰는 필드. 메시지에 있는 필드만 이 순서대로 이어 붙인다
+SIGNED_FIELDS = {
+    'Notification': ('Message', 'MessageId', 'Subject', 'Timestamp', 'TopicArn', 'Type'),
+    'SubscriptionConfirmation': ('Message', 'MessageId', 'SubscribeURL', 'Timestamp', 'Token', 'TopicArn', 'Type'),
+    'UnsubscribeConfirmation': ('Message', 'MessageId', 'SubscribeURL', 'Timestamp', 'Token', 'TopicArn', 'Type'),
+}
+SIGNATURE_HASHES = {'1': 'SHA-1', '2': 'SHA-256'}
+SNS_HOST = re.compile(r'^sns\.[a-z0-9-]+\.amazonaws\.com(\.cn)?$')
+
+_public_keys = {}
+
+
+class InvalidMessage(Exception):
+    pass
+
+
+def _check_url(url):
+    # 서명 인증서와 구독 확인 URL 은 SNS 도메인만 허용한다
+    parsed = urlparse(url)
+    if parsed.scheme != 'https' or not SNS_HOST.match(parsed.hostname or ''):
+        raise InvalidMessage(f'SNS 가 아닌 URL 입니다: {url}')
+    return url
+
+
+def _public_key(certificate):
+    # 인증서의 subjectPublicKeyInfo 에서 RSA 공개키를 꺼낸다
+    tbs_certificate = decoder.decode(ssl.PEM_cert_to_DER_cert(certificate))[0][0]
+    for item in tbs_certificate.values():
+        if isinstance(item, univ.Sequence) and len(item) == 2 and isinstance(item[1], univ.BitString):
+            return rsa.PublicKey.load_pkcs1(item[1].asOctets(), 'DER')
+    raise InvalidMessage('공개키가 없는 인증서입니다.')
+
+
+async def _get_public_key(url):
+    if url not in _public_keys:
+        with metrics.timed('sns', 'get_certificate'):
+            res = await asyncio.to_thread(requests.get, _check_url(url), timeout=5)
+        res.raise_for_status()
+        _public_keys[url] = _public_key(res.text)
+    return _public_keys[url]
+
+
+def signing_string(message):
+    fields = SIGNED_FIELDS.get(message.get('Type'))
+    if fields is None:
+        raise InvalidMessage(f'알 수 없는 메시지 종류입니다: {message.get("Type")}')
+    return ''.join(f'{field}\n{message[field]}\n' for field in fields if field in message)
+
+
+async def verify(message, topic_arn):
+    if not topic_arn or message.get('TopicArn') != topic_arn:
+        raise InvalidMessage('구독하지 않은 토픽입니다.')
+    hash_method = SIGNATURE_HASHES.get(message.get('SignatureVersion'))
+    if hash_method is None:
+        raise InvalidMessage('지원하지 않는 서명 버전입니다.')
+    public_key = await _get_public_key(message.get('SigningCertURL', ''))
+    try:
+        signature = b64decode(message.get('Signature', ''))
+        if rsa.verify(signing_string(message).encode(), signature, public_key) != hash_method:
+            raise InvalidMessage('서명 방식이 일치하지 않습니다.')
+    except (ValueError, rsa.VerificationError):
+        raise InvalidMessage('서명이 올바르지 않습니다.')
+
+
+async def confirm(message):
+    # HTTP 구독을 만들면 SNS 가 보내는 확인 메시지의 SubscribeURL 을 호출해야 알림이 온다
+    with metrics.timed('sns', 'confirm_subscription'):
+        res = await asyncio.to_thread(requests.get, _check_url(message['SubscribeURL']), timeout=5)
+    res.raise_for_status()
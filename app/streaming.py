@@ -0,0 +1,22 @@
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+from app.encoding import dumps
+
+NDJSON = 'application/x-ndjson'
+STREAM_BATCH_SIZE = 500
+
+
+def stream_mode(request: Request, stream: bool = False):
+    return stream or NDJSON in request.headers.get('accept', '')
+
+
+async def _encode(docs, transform):
+    async for doc in docs:
+        if transform is not None:
+            transform(doc)
+        yield dumps(doc) + b'\n'
+
+
+def ndjson_response(docs, transform=None):
+    return StreamingResponse(_encode(docs, transform), media_type=NDJSON)
@@ -0,0 +1,174 @@
+from datetime import datetime
+
+from bson import ObjectId
+
+from app import graph
+from app.database import redis, mongo
+from app.feed import get_cards
+from app.pagination import decode_cursor, encode_cursor
+
+TIMELINE_SIZE = 800
+TIMELINE_TTL = 60 * 60 * 24 * 7
+HEAVY_POSTER_FOLLOWERS = 5000
+HEAVY_POSTERS_KEY = 'timeline:heavy_posters'
+
+
+def timeline_key(user_id):
+    return f'timeline:{user_id}'
+
+
+def _score(created_at):
+    # Mongo 는 밀리초 단위까지만 저장하므로 점수도 밀리초로 맞춘다
+    return created_at.replace(microsecond=created_at.microsecond // 1000 * 1000).timestamp()
+
+
+def _push(pipe, user_id, entries):
+    key = timeline_key(user_id)
+    pipe.zadd(key, entries)
+    pipe.zremrangebyrank(key, 0, -TIMELINE_SIZE - 1)
+
+
+async def _existing_timelines(user_ids):
+    pipe = redis.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.exists(timeline_key(user_id))
+    return [user_id for user_id, exists in zip(user_ids, await pipe.execute()) if exists]
+
+
+async def is_heavy_poster(user_id):
+    return await redis.sismember(HEAVY_POSTERS_KEY, str(user_id))
+
+
+async def fan_out_post(post):
+    user_id = str(post['user_id'])
+    entries = {str(post['_id']): _score(post['created_at'])}
+
+    targets = [user_id]
+    if await graph.follower_count(user_id) >= HEAVY_POSTER_FOLLOWERS:
+        # 팔로워가 많은 유저는 fan-out 하지 않고 피드 조회 시 병합한다
+        await redis.sadd(HEAVY_POSTERS_KEY, user_id)
+    else:
+        targets += await graph.followers(user_id)
+
+    # 타임라인이 없는 유저는 다음 조회 시 rebuild 되므로 건너뛴다
+    pipe = redis.pipeline(transaction=False)
+    for target in await _existing_timelines(targets):
+        _push(pipe, target, entries)
+    await pipe.execute()
+
+
+async def remove_post(post):
+    # 나중에 팔로워가 많아진 유저의 게시물도 예전에 fan-out 된 타임라인에 남아 있으므로 항상 지운다
+    user_id = str(post['user_id'])
+    targets = [user_id, *await graph.followers(user_id)]
+
+    pipe = redis.pipeline(transaction=False)
+    for target in targets:
+        pipe.zrem(timeline_key(target), str(post['_id']))
+    await pipe.execute()
+
+
+async def add_author(user_id, author_id):
+    if not await redis.exists(timeline_key(user_id)) or await is_heavy_poster(author_id):
+        return
+    posts = mongo.posts.find({'user_id': ObjectId(author_id)}, {'created_at': 1}) \
+        .sort('created_at', -1).limit(TIMELINE_SIZE)
+    entries = {str(post['_id']): _score(post['created_at']) async for post in posts}
+    if entries:
+        pipe = redis.pipeline(transaction=False)
+        _push(pipe, user_id, entries)
+        await pipe.execute()
+
+
+async def remove_author(user_id, author_id):
+    key = timeline_key(user_id)
+    oldest = await redis.zrange(key, 0, 0, withscores=True)
+    if not oldest:
+        return
+    posts = mongo.posts.find({
+        'user_id': ObjectId(author_id),
+        'created_at': {'$gte': datetime.fromtimestamp(oldest[0][1])},
+    }, {'_id': 1})
+    post_ids = [str(post['_id']) async for post in posts]
+    if post_ids:
+        await redis.zrem(key, *post_ids)
+
+
+async def rebuild_timeline(user_id):
+    heavy = await redis.smembers(HEAVY_POSTERS_KEY)
+    author_ids = [ObjectId(following) for following in await graph.followings(user_id) if following not in heavy]
+    author_ids.append(ObjectId(user_id))
+
+    posts = mongo.posts.find({'user_id': {'$in': author_ids}}, {'created_at': 1}) \
+        .sort('created_at', -1).limit(TIMELINE_SIZE)
+    entries = {str(post['_id']): _score(post['created_at']) async for post in posts}
+
+    key = timeline_key(user_id)
+    pipe = redis.pipeline()
+    pipe.delete(key)
+    if entries:
+        pipe.zadd(key, entries)
+        pipe.expire(key, TIMELINE_TTL)
+    await pipe.execute()
+
+
+async def _heavy_followings(user_id):
+    heavy = await graph.following_in(user_id, HEAVY_POSTERS_KEY)
+    heavy.discard(str(user_id))
+    return [ObjectId(heavy_id) for heavy_id in heavy]
+
+
+async def read_timeline(user_id, limit, cursor=None):
+    key = timeline_key(user_id)
+    if await redis.exists(key):
+        await redis.expire(key, TIMELINE_TTL)
+    else:
+        await rebuild_timeline(user_id)
+
+    # 커서 이후의 limit + 1 개만 읽어 다음 페이지 여부를 판단한다
+    if cursor:
+        created_at, last_id = decode_cursor(cursor, 'created_at')
+        last = (_score(created_at), str(last_id))
+        pipe = redis.pipeline(transaction=False)
+        pipe.zrevrangebyscore(key, f'({last[0]}', '-inf', start=0, num=limit + 1, withscores=True)
+        pipe.zrangebyscore(key, last[0], last[0], withscores=True)
+        older, ties = await pipe.execute()
+        entries = older + [entry for entry in ties if entry[0] < last[1]]
+    else:
+        entries = await redis.zrevrange(key, 0, limit, withscores=True)
+
+    heavy_ids = await _heavy_followings(user_id)
+    if heavy_ids:
+        query = {'user_id': {'$in': heavy_ids}}
+        if cursor:
+            query = {'$and': [query, {'$or': [
+                {'created_at': {'$lt': created_at}},
+                {'created_at': created_at, '_id': {'$lt': last_id}},
+            ]}]}
+        heavy_posts = mongo.posts.find(query, {'created_at': 1}) \
+            .sort([('created_at', -1), ('_id', -1)]).limit(limit + 1)
+        entries += [(str(post['_id']), _score(post['created_at'])) async for post in heavy_posts]
+
+    ranked = {}
+    for post_id, score in sorted(entries, key=lambda entry: (entry[1], entry[0]), reverse=True):
+        ranked.setdefault(post_id, score)
+    ranked = list(ranked.items())[:limit + 1]
+
+    # 삭제된 게시물이 타임라인에 남아 있어도 페이지가 끊기지 않도록 커서는 타임라인 기준으로 만든다
+    next_cursor = None
+    if len(ranked) > limit:
+        ranked = ranked[:limit]
+        post_id, score = ranked[-1]
+        next_cursor = encode_cursor({'_id': post_id, 'created_at': datetime.fromtimestamp(score)}, 'created_at')
+
+    post_ids = [ObjectId(post_id) for post_id, _ in ranked]
+    posts = await get_cards(post_ids)
+    return [posts[post_id] for post_id in post_ids if post_id in posts], next_cursor
+
+
+async def iter_timeline_pages(user_id, batch_size, cursor=None):
+    while True:
+        posts, cursor = await read_timeline(user_id, batch_size, cursor)
+        yield posts
+        if cursor is None:
+            return
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import time
+
+from redis.commands.core import AsyncScript
+
+from app.database import redis
+
+logger = logging.getLogger(__name__)
+
+TRENDING_POSTS_KEY = 'trending:posts'
+TOP_LOCATIONS_KEY = 'trending:locations'
+EPOCHS_KEY = 'trending:epochs'
+
+# (반감기 초, 최대 항목 수)
+BOARDS = {
+    TRENDING_POSTS_KEY: (60 * 60 * 6, 1000),
+    TOP_LOCATIONS_KEY: (60 * 60 * 24 * 3, 500),
+}
+EVENT_WEIGHTS = {
+    'post': 1,
+    'like': 1,
+    'comment': 2,
+}
+MIN_SCORE = 0.01
+COMPACT_INTERVAL = 60 * 5
+
+# 점수를 매번 감쇠시키지 않고, 새 이벤트에 2^((now - epoch) / half_life) 배의 가중치를 준다.
+# 순위는 같고 읽기와 쓰기 모두 O(log N) 이다
+BUMP = AsyncScript(redis, b"""
+local now = tonumber(ARGV[3])
+local epoch = tonumber(redis.call('HGET', KEYS[2], KEYS[1]))
+if not epoch then
+    epoch = now
+    redis.call('HSET', KEYS[2], KEYS[1], ARGV[3])
+end
+return redis.call('ZINCRBY', KEYS[1], tonumber(ARGV[2]) * 2 ^ ((now - epoch) / tonumber(ARGV[4])), ARGV[1])
+""")
+
+# epoch 를 현재 쪽으로 옮겨 점수가 계속 커지지 않게 하고, 작아진 항목과 순위 밖 항목을 지운다
+COMPACT = AsyncScript(redis, b"""
+local now = tonumber(ARGV[1])
+local half_life = tonumber(ARGV[2])
+local epoch = tonumber(redis.call('HGET', KEYS[2], KEYS[1]))
+if not epoch then
+    return 0
+end
+local shift = math.floor((now - epoch) / half_life)
+if shift > 0 then
+    redis.call('ZUNIONSTORE', KEYS[1], 1, KEYS[1], 'WEIGHTS', tostring(2 ^ -shift))
+    epoch = epoch + shift * half_life
+    redis.call('HSET', KEYS[2], KEYS[1], tostring(epoch))
+end
+local threshold = tonumber(ARGV[4]) * 2 ^ ((now - epoch) / half_life)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. tostring(threshold))
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+return redis.call('ZCARD', KEYS[1])
+""")
+
+
+async def record(post, event):
+    weight = EVENT_WEIGHTS[event]
+    now = time.time()
+    pipe = redis.pipeline(transaction=False)
+    for board, member in ((TRENDING_POSTS_KEY, str(post['_id'])), (TOP_LOCATIONS_KEY, post['location_name'])):
+        await BUMP(keys=[board, EPOCHS_KEY], args=[member, weight, now, BOARDS[board][0]], client=pipe)
+    await pipe.execute()
+
+
+async def remove_post(post_id):
+    await redis.zrem(TRENDING_POSTS_KEY, str(post_id))
+
+
+async def top(board, limit):
+    pipe = redis.pipeline(transaction=False)
+    pipe.zrevrange(board, 0, limit - 1, withscores=True)
+    pipe.hget(EPOCHS_KEY, board)
+    entries, epoch = await pipe.execute()
+    # 저장된 점수를 현재 시점 기준으로 환산한다
+    decay = 2 ** ((time.time() - float(epoch)) / BOARDS[board][0]) if epoch else 1
+    return [(member, score / decay) for member, score in entries]
+
+
+async def compact():
+    now = time.time()
+    for board, (half_life, max_size) in BOARDS.items():
+        await COMPACT(keys=[board, EPOCHS_KEY], args=[now, half_life, max_size, MIN_SCORE])
+
+
+async def run_compactor():
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL)
+        try:
+            await compact()
+        except Exception:
+            logger.exception('트렌딩 정리 실패')
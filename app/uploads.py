@@ -0,0 +1,108 @@
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import unquote_plus
+from uuid import uuid4
+
+from app import inbox_sync, metrics
+from app.aws_client import s3_client
+from app.database import redis
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_BUCKET = 'w0nd3rwa11'
+UPLOAD_BASE_URL = f'https://{UPLOAD_BUCKET}.s3.ap-northeast-2.amazonaws.com'
+UPLOAD_POOL_KEY = 'upload:pool'
+UPLOAD_POOL_LOCK_KEY = 'upload:pool:lock'
+UPLOAD_POOL_SIZE = 200
+UPLOAD_REFILL_INTERVAL = 10
+# 풀에서 꺼낸 뒤에도 최소 UPLOAD_MIN_REMAINING 초는 쓸 수 있도록 넉넉한 만료로 서명한다
+UPLOAD_EXPIRES_IN = 60 * 20
+UPLOAD_MIN_REMAINING = 60 * 5
+PENDING_UPLOAD_TTL = UPLOAD_EXPIRES_IN
+
+
+def pending_key(key):
+    return f'upload:pending:{key}'
+
+
+def picture_url(key):
+    return f'{UPLOAD_BASE_URL}/{key}'
+
+
+def _sign():
+    key = f'images_{uuid4()}'
+    with metrics.timed('s3', 'generate_presigned_post'):
+        grant = s3_client.generate_presigned_post(
+            Bucket=UPLOAD_BUCKET,
+            Key=key,
+            ExpiresIn=UPLOAD_EXPIRES_IN,
+            Fields={
+                'acl': 'public-read',
+                'Content-Type': 'image/'
+            },
+        )
+    return {**grant, 'key': key, 'expires_at': int(time.time()) + UPLOAD_EXPIRES_IN}
+
+
+async def refill():
+    # 여러 워커가 동시에 채우지 않도록 잠근다
+    if not await redis.set(UPLOAD_POOL_LOCK_KEY, 1, nx=True, ex=UPLOAD_REFILL_INTERVAL * 6):
+        return 0
+    try:
+        await redis.zremrangebyscore(UPLOAD_POOL_KEY, '-inf', time.time() + UPLOAD_MIN_REMAINING)
+        missing = UPLOAD_POOL_SIZE - await redis.zcard(UPLOAD_POOL_KEY)
+        if missing <= 0:
+            return 0
+        grants = await asyncio.to_thread(lambda: [_sign() for _ in range(missing)])
+        await redis.zadd(UPLOAD_POOL_KEY, {json.dumps(grant): grant['expires_at'] for grant in grants})
+        return len(grants)
+    finally:
+        await redis.delete(UPLOAD_POOL_LOCK_KEY)
+
+
+async def run_refiller():
+    while True:
+        try:
+            await refill()
+        except Exception:
+            logger.exception('업로드 풀 채우기 실패')
+        await asyncio.sleep(UPLOAD_REFILL_INTERVAL)
+
+
+async def take_grant():
+    pipe = redis.pipeline()
+    pipe.zremrangebyscore(UPLOAD_POOL_KEY, '-inf', time.time() + UPLOAD_MIN_REMAINING)
+    pipe.zpopmin(UPLOAD_POOL_KEY)
+    _, popped = await pipe.execute()
+    if popped:
+        return json.loads(popped[0][0])
+    # 풀이 비었으면 요청 경로에서 바로 서명한다
+    return await asyncio.to_thread(_sign)
+
+
+async def start_upload(phone, location):
+    grant = await take_grant()
+    await redis.set(pending_key(grant['key']), json.dumps({'phone': phone, 'location': location}),
+                    ex=PENDING_UPLOAD_TTL)
+    return grant
+
+
+async def complete_upload(key):
+    # S3 이벤트는 중복 전달될 수 있으므로 GETDEL 로 한 번만 처리한다
+    pending = await redis.getdel(pending_key(key))
+    if pending is None:
+        return False
+    pending = json.loads(pending)
+    await inbox_sync.insert_entries([{
+        'phone': pending['phone'],
+        'picture': picture_url(key),
+        'location': pending['location'],
+    }])
+    return True
+
+
+def event_keys(event):
+    return [unquote_plus(record['s3']['object']['key']) for record in event.get('Records', [])
+            if record.get('s3', {}).get('bucket', {}).get('name') == UPLOAD_BUCKET]
@@ -0,0 +1,350 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+
+STUB_CONFIG = {
+    'STRIPE_SECRET_KEY': 'sk_test_bench',
+    'STRIPE_WEBHOOK_SECRET': 'whsec_bench',
+    'INFRASTRUCTURE': 'localhost',
+    'REDIS_PASSWORD': '',
+    'MONGO_USERNAME': '',
+    'MONGO_PASSWORD': '',
+    'JWT_SECRET': 'bench',
+    'AWS_ACCESS_KEY_ID': 'bench',
+    'AWS_SECRET_ACCESS_KEY': 'bench',
+    'S3_ACCESS_KEY_ID': 'bench',
+    'S3_SECRET_ACCESS_KEY': 'bench',
+    'SMS_SENDER': 'fake',
+}
+
+
+def setup(backend):
+    for key, value in STUB_CONFIG.items():
+        os.environ.setdefault(key, value)
+
+    from pymongo import IndexModel, monitoring
+
+    from app import indexes
+
+    # 벤치마크 중 실행된 쿼리를 모아 인덱스를 쓰는지 확인한다
+    recorder = indexes.QueryRecorder()
+    if backend == 'local':
+        monitoring.register(recorder)
+        return recorder
+
+    import fakeredis
+    from mongomock_motor import AsyncMongoMockClient
+
+    from app import database
+
+    async def noop():
+        pass
+
+    database.redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    database.client = AsyncMongoMockClient()
+    database.mongo = database.client.mycut4cut
+    database.connect = noop
+    database.warmup = noop
+    database.close = noop
+
+    # mongomock 은 $lookup 의 pipeline 옵션과 partialFilterExpression 을 지원하지 않는다
+    from app import feed
+    feed.AUTHOR_LOOKUP[0]['$lookup'].pop('pipeline', None)
+    # idempotency_key 는 항상 문자열이므로 sparse 인덱스로 같은 중복 검사를 한다
+    indexes.INDEXES['inbox'] = [
+        IndexModel(list(index.document['key'].items()), unique=True, sparse=True)
+        if 'partialFilterExpression' in index.document else index
+        for index in indexes.INDEXES['inbox']
+    ]
+
+    # mongomock 은 command 이벤트를 내지 않으므로 필터와 정렬을 직접 기록한다
+    from mongomock.collection import Collection
+    iter_documents, get_dataset, aggregate = Collection._iter_documents, Collection._get_dataset, Collection.aggregate
+    # aggregate 는 내부적으로 전체 컬렉션을 읽고, find 는 정렬과 함께 기록했으므로 그 안에서는 기록하지 않는다
+    nested = []
+
+    def record_iter_documents(self, filter):
+        if not nested:
+            recorder.record(self.name, filter or {})
+        return iter_documents(self, filter)
+
+    def record_get_dataset(self, spec, sort, *args):
+        if not nested:
+            recorder.record(self.name, spec or {}, sort.items() if isinstance(sort, dict) else sort or ())
+        nested.append(True)
+        try:
+            yield from get_dataset(self, spec, sort, *args)
+        finally:
+            nested.pop()
+
+    def record_aggregate(self, pipeline, *args, **kwargs):
+        recorder.record_pipeline(self.name, pipeline)
+        nested.append(True)
+        try:
+            return aggregate(self, pipeline, *args, **kwargs)
+        finally:
+            nested.pop()
+
+    Collection._iter_documents = record_iter_documents
+    Collection._get_dataset = record_get_dataset
+    Collection.aggregate = record_aggregate
+    return recorder
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.elapsed = {}
+
+    async def call(self, name, request):
+        start = time.perf_counter()
+        res = await request
+        self.latencies.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+        if res.status_code >= 400:
+            raise RuntimeError(f'{name}: {res.status_code} {res.text}')
+        return res
+
+    def report(self):
+        results = {}
+        for name, latencies in self.latencies.items():
+            results[name] = {
+                'count': len(latencies),
+                'p50': round(percentile(latencies, 50), 3),
+                'p95': round(percentile(latencies, 95), 3),
+                'p99': round(percentile(latencies, 99), 3),
+                'throughput': round(len(latencies) / self.elapsed[name], 1),
+            }
+        return results
+
+
+async def seed(users):
+    from bson import ObjectId
+    from jose import jwt
+
+    from app import graph
+    from app.config import config
+    from app.database import mongo
+
+    user_ids = [ObjectId() for _ in range(users)]
+    await mongo.users.insert_many([
+        {'_id': user_id, 'name': f'user{i}', 'phone': f'010{i:08d}', 'is_public': True}
+        for i, user_id in enumerate(user_ids)
+    ])
+    # 모든 유저가 앞쪽 10명을 팔로우한다
+    for user_id in user_ids:
+        for author_id in user_ids[:10]:
+            if author_id != user_id:
+                await graph.follow(str(user_id), str(author_id), graph.ACCEPTED)
+
+    tokens = {}
+    for i, user_id in enumerate(user_ids):
+        tokens[str(user_id)] = jwt.encode({
+            '_id': str(user_id),
+            'phone': f'010{i:08d}',
+            'ver': 0,
+            'iat': int(datetime.now().timestamp()),
+            'exp': int((datetime.now() + timedelta(days=1)).timestamp()),
+        }, config['JWT_SECRET'], algorithm='HS256')
+    return [str(user_id) for user_id in user_ids], tokens
+
+
+def stripe_webhook(event_type, created, customer, status):
+    import stripe
+
+    # 로컬 Stripe 대신 같은 비밀 키로 서명한 이벤트를 만든다
+    payload = json.dumps({
+        'id': f'evt_{customer}_{created}',
+        'object': 'event',
+        'type': event_type,
+        'created': created,
+        'data': {'object': {'id': f'sub_{customer}', 'object': 'subscription', 'customer': customer,
+                            'status': status}},
+    })
+    timestamp = int(time.time())
+    signature = stripe.WebhookSignature._compute_signature(f'{timestamp}.{payload}',
+                                                           os.environ['STRIPE_WEBHOOK_SECRET'])
+    return {'content': payload, 'headers': {'Stripe-Signature': f't={timestamp},v1={signature}',
+                                            'Content-Type': 'application/json'}}
+
+
+async def run_scenario(recorder, name, iterations, concurrency, make_request):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            await make_request(i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(iterations)])
+    recorder.elapsed[name] = time.perf_counter() - start
+
+
+async def bench(iterations, concurrency, users):
+    import httpx
+
+    from app.database import mongo, redis
+    from app.main import app
+
+    recorder = Recorder()
+    async with app.router.lifespan_context(app):
+        user_ids, tokens = await seed(users)
+
+        def headers(i):
+            return {'Authorization': f'Bearer {tokens[user_ids[i % len(user_ids)]]}'}
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            async def auth_verify(i):
+                # 기기마다 다른 IP 로 요청해야 IP 단위 rate limit 에 걸리지 않는다
+                device = httpx.ASGITransport(app=app, client=(f'10.0.{i // 250}.{i % 250 + 1}', 123))
+                async with httpx.AsyncClient(transport=device, base_url='http://bench') as kiosk:
+                    phone = f'019{i:08d}'
+                    await recorder.call('auth_phone', kiosk.post('/auth/phone', json={'phone': phone}))
+                    code = await redis.get(f'phoneauth:{phone}')
+                    await recorder.call('auth_verify', kiosk.post('/auth/verify', json={
+                        'name': f'bench{i}', 'phone': phone, 'code': code,
+                    }))
+
+            post_ids = []
+
+            async def new_post(i):
+                author = i % 10
+                tagged = [user_ids[(author + k) % len(user_ids)] for k in range(1, 6)]
+                res = await recorder.call('new_post', client.post('/post/', headers=headers(author), json={
+                    'picture_url': f'https://example.com/{i}.jpg',
+                    'tagged_user_ids': tagged,
+                    'location_name': f'location{i % 5}',
+                }))
+                post_ids.append(res.json()['post_id'])
+
+            async def feed(i):
+                await recorder.call('feed', client.get('/post/', headers=headers(i)))
+
+            async def like_comment(i):
+                post_id = post_ids[i % len(post_ids)]
+                await recorder.call('like', client.post(f'/post/{post_id}/like', headers=headers(i)))
+                await recorder.call('comment', client.post(f'/post/{post_id}/comment', headers=headers(i),
+                                                           json={'content': f'comment {i}'}))
+
+            async def inbox(i):
+                await recorder.call('inbox', client.get('/inbox/', headers=headers(i)))
+
+            async def webhook(i):
+                # 취소 뒤에 늦게 도착한 updated 이벤트가 구독을 되살리면 안 된다
+                customer = user_ids[i % len(user_ids)]
+                created = int(time.time()) + i * 10
+                for event_type, offset, status in (('customer.subscription.created', 0, 'active'),
+                                                   ('customer.subscription.deleted', 2, 'canceled'),
+                                                   ('customer.subscription.updated', 1, 'active')):
+                    await recorder.call('webhook', client.post('/subscription/webhook', **stripe_webhook(
+                        event_type, created + offset, customer, status)))
+
+            await run_scenario(recorder, 'auth_phone', iterations, concurrency, auth_verify)
+            recorder.elapsed['auth_verify'] = recorder.elapsed['auth_phone']
+            await run_scenario(recorder, 'new_post', iterations, concurrency, new_post)
+            await run_scenario(recorder, 'feed', iterations, concurrency, feed)
+            await run_scenario(recorder, 'like', iterations, concurrency, like_comment)
+            recorder.elapsed['comment'] = recorder.elapsed['like']
+            await run_scenario(recorder, 'inbox', iterations, concurrency, inbox)
+
+            # 같은 idempotency_key 는 한 번만 저장되고 재전송은 duplicate 로 응답해야 한다
+            items = [{'phone': '01000000000', 'picture': 'https://example.com/dedup.jpg', 'location': 'bench',
+                      'idempotency_key': f'dedup{key}'} for key in (0, 0, 1)]
+            for expected in (['created', 'duplicate', 'created'], ['duplicate'] * 3):
+                res = await client.post('/inbox/batch', json={'items': items})
+                statuses = [result['status'] for result in res.json()['results']]
+                if statuses != expected:
+                    raise RuntimeError(f'inbox_batch: {statuses} != {expected}')
+            if await mongo.inbox.count_documents({'idempotency_key': {'$in': ['dedup0', 'dedup1']}}) != 2:
+                raise RuntimeError('inbox_batch: duplicate items stored')
+
+            # 시간은 재지 않고 읽기 경로의 쿼리를 인덱스 검사에 기록한다
+            post_id = post_ids[0]
+            for path in ('/inbox/sync', f'/post/{post_id}', f'/post/{post_id}/comment', f'/post/{post_id}/like',
+                         '/user/me/posts', '/user/me/followers', '/user/me/followings', f'/user/{user_ids[0]}/posts',
+                         f'/user/{user_ids[0]}/followers', f'/user/{user_ids[0]}/common_followings'):
+                res = await client.get(path, headers=headers(1))
+                if res.status_code >= 400:
+                    raise RuntimeError(f'{path}: {res.status_code} {res.text}')
+
+            forged = stripe_webhook('customer.subscription.updated', 0, user_ids[0], 'active')
+            forged['headers']['Stripe-Signature'] += '0'
+            if (await client.post('/subscription/webhook', **forged)).status_code != 400:
+                raise RuntimeError('webhook: forged signature accepted')
+            await run_scenario(recorder, 'webhook', iterations, concurrency, webhook)
+            for user_id in user_ids:
+                res = await client.get(f'/subscription/status/{user_id}')
+                if res.json()['subscription_status'] != 'inactive':
+                    raise RuntimeError(f'webhook: {user_id} reactivated by an out-of-order event')
+
+    return recorder.report()
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, base in baseline.items():
+        current = results.get(name)
+        if current is None:
+            continue
+        # 꼬리 지연은 GC 등 단발성 정지에 크게 흔들리므로 p50 과 처리량으로 판정한다
+        if current['p50'] > base['p50'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {current['p50']}ms > baseline {base['p50']}ms")
+        if current['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {current['throughput']}/s < baseline {base['throughput']}/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MyCut4Cut API latency benchmark')
+    parser.add_argument('--backend', choices=['mock', 'local'], default='mock',
+                        help='mock: mongomock + fakeredis, local: docker-compose Mongo/Redis from .env')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    parser.add_argument('--baseline', type=Path, default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    recorder = setup(args.backend)
+    results = asyncio.run(bench(args.iterations, args.concurrency, args.users))
+
+    print(f"{'endpoint':<12}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'req/s':>10}")
+    for name, row in results.items():
+        print(f"{name:<12}{row['count']:>8}{row['p50']:>10}{row['p95']:>10}{row['p99']:>10}{row['throughput']:>10}")
+
+    uncovered = recorder.uncovered()
+    if uncovered:
+        print('인덱스를 쓰지 않는 쿼리:')
+        for collection, query, sort in uncovered:
+            print(f'  {collection}: {query} sort={list(sort)}')
+        sys.exit(1)
+
+    if args.update_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + '\n')
+        return
+
+    if args.baseline.exists():
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        if regressions:
+            print('\n'.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()